@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import, division, print_function
+
+__metaclass__ = type
+
+import time
+
+from ansible.plugins.callback import CallbackBase
+
+DOCUMENTATION = """
+    callback: apm_metrics
+    type: aggregate
+    short_description: summarize metrics of apm tasks
+    description:
+      - Adds up the metrics returned by the apm module across hosts and tasks
+        and displays them at the end of the play.
+      - The overhead is the duration of a task on a host that is not spent in
+        the module, like transferring and starting the module.
+    requirements:
+      - enable in configuration
+"""
+
+
+class CallbackModule(CallbackBase):
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = "aggregate"
+    CALLBACK_NAME = "apm_metrics"
+    CALLBACK_NEEDS_WHITELIST = True
+    CALLBACK_NEEDS_ENABLED = True
+
+    def __init__(self):
+        super(CallbackModule, self).__init__()
+        self.task_started = None
+        self.summary = {}
+
+    def v2_playbook_on_task_start(self, task, is_conditional):
+        self.task_started = time.monotonic()
+
+    def v2_runner_on_ok(self, result):
+        self.add_result(result)
+
+    def v2_runner_on_failed(self, result, ignore_errors=False):
+        self.add_result(result)
+
+    def add_result(self, result):
+        metrics = result._result.get("metrics")
+
+        if not isinstance(metrics, dict):
+            return
+
+        task = result._task.get_name()
+        summary = self.summary.setdefault(
+            task,
+            {
+                "hosts": 0,
+                "total": 0.0,
+                "overhead": 0.0,
+                "phases": {},
+                "subprocesses": 0,
+                "subprocess_time": 0.0,
+                "output_bytes": 0,
+                "cache": {},
+                "slowest": None,
+            },
+        )
+
+        summary["hosts"] += 1
+        summary["total"] += metrics.get("total", 0.0)
+        if self.task_started is not None:
+            elapsed = time.monotonic() - self.task_started
+            summary["overhead"] += max(elapsed - metrics.get("total", 0.0), 0.0)
+
+        for name, duration in metrics.get("phases", {}).items():
+            summary["phases"][name] = summary["phases"].get(name, 0.0) + duration
+
+        for command in metrics.get("commands", []):
+            summary["subprocesses"] += 1
+            summary["subprocess_time"] += command.get("duration", 0.0)
+            slowest = summary["slowest"]
+            if slowest is None or command.get("duration", 0.0) > slowest[1]:
+                summary["slowest"] = (command.get("command"), command["duration"])
+
+        summary["output_bytes"] += metrics.get("output_bytes", 0)
+        for name, counts in metrics.get("cache", {}).items():
+            total = summary["cache"].setdefault(name, {"hit": 0, "miss": 0})
+            total["hit"] += counts.get("hit", 0)
+            total["miss"] += counts.get("miss", 0)
+
+    def v2_playbook_on_stats(self, stats):
+        if not self.summary:
+            return
+
+        self._display.banner("APM METRICS")
+        for task, summary in self.summary.items():
+            lines = [
+                "{0} ({1} hosts)".format(task, summary["hosts"]),
+                "  module: {0:.3f}s, overhead: {1:.3f}s".format(
+                    summary["total"], summary["overhead"]
+                ),
+            ]
+            for name, duration in sorted(summary["phases"].items()):
+                lines.append("  phase {0}: {1:.3f}s".format(name, duration))
+            lines.append(
+                "  subprocesses: {0} in {1:.3f}s, output: {2} bytes".format(
+                    summary["subprocesses"],
+                    summary["subprocess_time"],
+                    summary["output_bytes"],
+                )
+            )
+            if summary["slowest"]:
+                lines.append("  slowest: {0} ({1:.3f}s)".format(*summary["slowest"]))
+            for name, counts in sorted(summary["cache"].items()):
+                lines.append(
+                    "  cache {0}: {1} hit, {2} miss".format(
+                        name, counts["hit"], counts["miss"]
+                    )
+                )
+            self._display.display("\n".join(lines))
@@ -1,44 +1,370 @@
 #!/usr/bin/env python
 
+import asyncio
+import base64
+import cProfile
+import fcntl
+import functools
+import hashlib
+import http.client
+import json
+import os
+import re
+import shlex
+import shutil
+import struct
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from queue import Queue
+
+from ansible.module_utils._text import to_native
+from ansible.module_utils.apm_common import (
+    STATE_DIRECTORY,
+    READ_SIZE,
+    TIMEOUT_RC,
+    execute,
+    find_core,
+    get_disabled_packages,
+    get_fingerprint,
+    has_native_modules,
+    parse_outdated_packages,
+    read_config,
+    read_state,
+    scan_packages,
+    write_state,
+)
 from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.six.moves.urllib.parse import (
+    quote,
+    unquote,
+    urljoin,
+    urlsplit,
+)
+from ansible.module_utils.six.moves.urllib.request import getproxies, proxy_bypass
+from ansible.module_utils.urls import open_url
+
+STATES = ["latest", "present", "absent", "disabled", "enabled"]
+COMMIT_PATTERN = re.compile(r"^[0-9a-f]{40}$")
+REGISTRY_TIMEOUT = 30
+ARTIFACT_MODE = 0o664
+ARTIFACT_DIRECTORY_MODE = 0o2775
+PROFILE_ENVIRONMENT = "ANSIBLE_APM_PROFILE"
+TRASH_DIRECTORY = os.path.join(STATE_DIRECTORY, "trash")
+ATOM_ARCHIVES = (
+    "/Applications/Atom.app/Contents/Resources/app.asar",
+    "/usr/share/atom/resources/app.asar",
+)
+FICLONE = 0x40049409
+CACHE_ENTRIES = (
+    (".apm", 2),
+    (os.path.join(".node-gyp", ".node-gyp"), 1),
+    (os.path.join(".node-gyp", ".cache", "node-gyp"), 1),
+)
+CACACHE = os.path.join(".apm", "_cacache")
+TARBALL_PATTERN = re.compile(r"/((?:@[^/]+/)?[^/]+)/-/[^/]+-(\d[^/]*)\.tgz$")
+
+
+def timed(name):
+    """
+    decorator that adds the duration of the method to the phase of metrics
+    """
+
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.phase(name):
+                return method(self, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
 
 
 class ApmModule:
     def __init__(self):
         self.module = AnsibleModule(
             argument_spec={
-                "name": {"type": "str", "required": True},
+                "name": {"type": "str"},
                 "state": {
-                    "choices": ["latest", "present", "absent"],
+                    "choices": STATES,
                     "default": "present",
                 },
+                "atom_home": {"type": "path"},
+                "packages": {
+                    "type": "list",
+                    "elements": "dict",
+                    "options": {
+                        "name": {"type": "str", "required": True},
+                        "state": {"choices": STATES},
+                        "source": {"choices": ["registry", "git"]},
+                        "repo": {"type": "str"},
+                        "version": {"type": "str"},
+                    },
+                    "required_if": [("source", "git", ["repo"])],
+                },
+                "outdated_cache_ttl": {"type": "int", "default": 0},
+                "force_refresh": {"type": "bool", "default": False},
+                "workers": {"type": "int", "default": 1},
+                "timeout": {"type": "int", "default": 0},
+                "deadline": {"type": "int", "default": 0},
+                "lockfile": {"type": "path"},
+                "update_lockfile": {"type": "bool", "default": False},
+                "registry_url": {"type": "str", "default": "https://atom.io/api"},
+                "outdated_source": {
+                    "type": "str",
+                    "choices": ["apm", "registry"],
+                    "default": "apm",
+                },
+                "registry_connections": {"type": "int", "default": 4},
+                "artifact_cache": {"type": "path"},
+                "artifact_cache_max_size": {"type": "int", "default": 1024},
+                "package_store": {"type": "path"},
+                "package_store_link": {
+                    "type": "str",
+                    "choices": ["hardlink", "reflink", "copy"],
+                    "default": "hardlink",
+                },
+                "electron_version": {"type": "str"},
+                "rebuild": {"type": "bool"},
+                "cache_max_size": {"type": "int", "default": 0},
+                "uninstall_mode": {
+                    "type": "str",
+                    "choices": ["apm", "trash"],
+                    "default": "apm",
+                },
+                "trash_purge_budget": {"type": "int", "default": 10},
+                "facts": {"type": "dict"},
+                "facts_max_age": {"type": "int", "default": 600},
             },
+            mutually_exclusive=[["name", "packages"]],
+            required_one_of=[["name", "packages", "rebuild"]],
+            required_by={"lockfile": "packages"},
             supports_check_mode=True,
         )
         self.stdout = ""
         self.stderr = ""
+        self.results = []
+        self.rebuilt = []
+        self.pruned = None
+        self.git = {}
+        self.atom_home = (
+            self.module.params["atom_home"]
+            or os.environ.get("ATOM_HOME")
+            or os.path.expanduser("~/.atom")
+        )
+        self.electron_version = None
+        self.timed_out = []
+        self.deadline = None
+        self.started = time.monotonic()
+        self.metrics = {"phases": {}, "commands": [], "output_bytes": 0, "cache": {}}
+
+        if self.module.params["deadline"] > 0:
+            self.deadline = time.monotonic() + self.module.params["deadline"]
+
+    @contextmanager
+    def phase(self, name):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            phases = self.metrics["phases"]
+            phases[name] = phases.get(name, 0) + time.monotonic() - started
+
+    def count_cache(self, name, hit):
+        counts = self.metrics["cache"].setdefault(name, {"hit": 0, "miss": 0})
+        counts["hit" if hit else "miss"] += 1
+
+    def get_metrics(self):
+        metrics = dict(self.metrics)
+        metrics["phases"] = dict(
+            (name, round(duration, 6)) for name, duration in metrics["phases"].items()
+        )
+        metrics["subprocesses"] = len(metrics["commands"])
+        metrics["total"] = round(time.monotonic() - self.started, 6)
+        return metrics
+
+    def read_state(self, filename):
+        return read_state(self.atom_home, filename)
+
+    def write_state(self, filename, data):
+        write_state(self.atom_home, filename, data)
+
+    def get_package_index(self):
+        """
+        read name and version of installed packages from
+        $ATOM_HOME/packages/*/package.json, returns None when the layout
+        of the directory is unexpected
+        """
+        packages_directory = os.path.join(self.atom_home, "packages")
+
+        try:
+            mtime = os.stat(packages_directory).st_mtime_ns
+        except OSError:
+            return None
+
+        cache = self.read_state("installed.json")
+        hit = bool(cache) and cache.get("mtime") == mtime
+        self.count_cache("installed", hit)
+        if hit:
+            return cache["packages"]
+
+        packages = scan_packages(self.atom_home)
+        if packages is None:
+            return None
+        index = dict((name, package[0]) for name, package in packages.items())
+
+        # don't cache an index that may have been changed while scanning
+        if os.stat(packages_directory).st_mtime_ns == mtime:
+            self.write_state("installed.json", {"mtime": mtime, "packages": index})
+
+        return index
+
+    def get_facts(self):
+        """
+        returns facts gathered by apm_facts while the packages directory
+        is unchanged, or None
+        """
+        facts = self.module.params["facts"]
+
+        if not facts:
+            return None
+
+        try:
+            mtime = os.stat(os.path.join(self.atom_home, "packages")).st_mtime_ns
+        except OSError:
+            mtime = None
+
+        age = time.time() - facts.get("time", 0)
+        valid = (
+            mtime is not None
+            and facts.get("atom_home") == self.atom_home
+            and facts.get("mtime") == mtime
+            and 0 <= age < self.module.params["facts_max_age"]
+        )
+        self.count_cache("facts", valid)
+        return facts if valid else None
+
+    def get_fingerprint(self, installed):
+        return get_fingerprint(installed)
+
+    def parse_installed_packages(self, stdout):
+        """
+        parse output of `apm list --json` into name -> version,
+        falls back to output of `apm list --bare` of old apm
+        """
+        installed = {}
+
+        try:
+            groups = json.loads(stdout)
+            for packages in groups.values():
+                for package in packages:
+                    installed[package["name"]] = package.get("version")
+            return installed
+        except (ValueError, AttributeError, KeyError, TypeError):
+            installed = {}
+
+        for line in stdout.splitlines():
+            name, separator, version = line.strip().rpartition("@")
+            if separator and name:
+                installed[name] = version
+
+        return installed
+
+    def parse_outdated_packages(self, stdout):
+        return parse_outdated_packages(stdout)
 
     def is_package_installed(self, name):
-        rc, stdout, stderr, installed = (0, "", "", False)
-        command = "apm list --bare --color=false"
-        rc, stdout, stderr = self.module.run_command(command)
+        rc, installed = self.get_installed_packages()
+        return (rc, name in installed)
+
+    def is_not_package_latest(self, name):
+        rc, outdated = self.get_outdated_packages([name])
+        return (rc, name in outdated)
+
+    @timed("installed")
+    def get_installed_packages(self):
+        rc, stdout, stderr, installed = (0, "", "", {})
+        command = "apm list --json --bare --color=false"
+        facts = self.get_facts()
+
+        if facts:
+            installed = dict(
+                (name, package["version"])
+                for name, package in facts["installed"].items()
+            )
+            return (rc, installed)
+
+        index = self.get_package_index()
 
-        if rc == 0 and stdout.find(name + "@") >= 0:
-            installed = True
+        if index is not None:
+            return (rc, index)
+
+        rc, stdout, stderr = self.run_command(command)
+
+        if rc == 0:
+            installed = self.parse_installed_packages(stdout)
 
         self.stdout, self.stderr = stdout, stderr
         return (rc, installed)
 
-    def is_not_package_latest(self, name):
-        rc, stdout, stderr, not_latest = (0, "", "", False)
-        command = "apm upgrade --list --color=false"
-        rc, stdout, stderr = self.module.run_command(command)
+    @timed("outdated")
+    def get_outdated_packages(self, names=None):
+        """
+        returns name -> latest version of outdated packages, only names are
+        looked up when outdated_source is registry
+        """
+        rc, stdout, stderr, outdated = (0, "", "", {})
+        command = "apm upgrade --list --json --color=false"
+        ttl = self.module.params["outdated_cache_ttl"]
+        fingerprint = None
+
+        # the registry only looks up managed packages, so outdated packages
+        # of facts, that are listed for all installed packages, are not used
+        if self.module.params["outdated_source"] == "registry" and names is not None:
+            return self.get_registry_outdated(names)
+
+        facts = self.get_facts()
+        if facts and facts.get("outdated") is not None:
+            if not self.module.params["force_refresh"]:
+                return (rc, facts["outdated"])
 
-        if rc == 0 and stdout.find(" " + name + " ") >= 0:
-            not_latest = True
+        # `apm upgrade --list` queries the registry for every installed
+        # package, so the result is reused while the installed packages
+        # are the same and the ttl is not expired
+        if ttl > 0:
+            index = self.get_package_index()
+            if index is not None:
+                fingerprint = self.get_fingerprint(index)
+
+        if fingerprint and not self.module.params["force_refresh"]:
+            cache = self.read_state("outdated.json")
+            hit = (
+                bool(cache)
+                and cache.get("fingerprint") == fingerprint
+                and 0 <= time.time() - cache.get("time", 0) < ttl
+            )
+            self.count_cache("outdated", hit)
+            if hit:
+                return (rc, cache["packages"])
+
+        rc, stdout, stderr = self.run_command(command)
+
+        if rc == 0:
+            outdated = self.parse_outdated_packages(stdout)
+
+        if rc == 0 and fingerprint:
+            self.write_state(
+                "outdated.json",
+                {"fingerprint": fingerprint, "time": time.time(), "packages": outdated},
+            )
 
         self.stdout, self.stderr = stdout, stderr
-        return (rc, not_latest)
+        return (rc, outdated)
 
     def package_install(self, name):
         rc, stdout, stderr, changed = (0, "", "", False)
@@ -46,7 +372,7 @@ class ApmModule:
         rc, installed = self.is_package_installed(name)
 
         if rc == 0 and not installed:
-            rc, stdout, stderr = self.module.run_command(command)
+            rc, stdout, stderr = self.run_command(command)
             changed = True
 
         self.stdout, self.stderr = stdout, stderr
@@ -59,7 +385,7 @@ class ApmModule:
 
         if rc == 0:
             if not_latest:
-                rc, stdout, stderr = self.module.run_command(command)
+                rc, stdout, stderr = self.run_command(command)
                 self.stdout, self.stderr = stdout, stderr
                 changed = True
             else:
@@ -73,40 +399,2015 @@ class ApmModule:
         rc, installed = self.is_package_installed(name)
 
         if rc == 0 and installed:
-            rc, stdout, stderr = self.module.run_command(command)
+            if self.module.params["uninstall_mode"] == "trash":
+                rc = self.trash_packages([name])
+                stderr = self.stderr
+            else:
+                rc, stdout, stderr = self.run_command(command)
             changed = True
 
         self.stdout, self.stderr = stdout, stderr
         return (rc, changed)
 
+    def get_states(self, packages):
+        default_state = self.module.params["state"]
+        states = {}
+
+        for package in packages:
+            states[package["name"]] = package.get("state") or default_state
+
+        return states
+
+    def get_git_packages(self, packages):
+        """
+        returns name -> {repo, version} of packages from git, repo is
+        owner/repo on github or a url
+        """
+        git = {}
+
+        for package in packages:
+            if package.get("source") != "git":
+                continue
+            repo = package["repo"]
+            if re.match(r"^[\w.-]+/[\w.-]+$", repo):
+                repo = "https://github.com/{0}.git".format(repo)
+            git[package["name"]] = {"repo": repo, "version": package.get("version")}
+
+        return git
+
+    def read_lockfile(self):
+        """
+        read name -> version of packages pinned by the lockfile, the
+        lockfile is ignored when it will be generated by this run
+        """
+        path = self.module.params["lockfile"]
+
+        if not path or self.module.params["update_lockfile"]:
+            return (0, {})
+        if not os.path.exists(path):
+            return (0, {})
+
+        try:
+            with open(path) as f:
+                pins = json.load(f)["packages"]
+            return (0, dict((str(k), str(v)) for k, v in pins.items()))
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+            self.stderr = "invalid lockfile {0}: {1}".format(path, to_native(e))
+            return (1, {})
+
+    def write_lockfile(self, states):
+        """
+        write installed versions of managed packages to the lockfile,
+        returns whether the lockfile is changed
+        """
+        path = self.module.params["lockfile"]
+
+        if not path or (
+            os.path.exists(path) and not self.module.params["update_lockfile"]
+        ):
+            return (0, False)
+
+        rc, installed = self.get_installed_packages()
+        if rc != 0:
+            return (rc, False)
+
+        pins = {}
+        for name, state in states.items():
+            if state != "absent" and name in installed:
+                pins[name] = installed[name]
+                if name in self.git:
+                    pins[name] = self.get_git_commit(name) or installed[name]
+
+        content = json.dumps({"packages": pins}, indent=2, sort_keys=True) + "\n"
+        try:
+            with open(path) as f:
+                if f.read() == content:
+                    return (0, False)
+        except OSError:
+            pass
+
+        try:
+            directory = os.path.dirname(os.path.abspath(path))
+            fd, temporary = tempfile.mkstemp(dir=directory, prefix=".lockfile")
+            with os.fdopen(fd, "w") as f:
+                f.write(content)
+            os.replace(temporary, path)
+        except OSError as e:
+            self.stderr = "failed to write lockfile {0}: {1}".format(path, to_native(e))
+            return (1, False)
+
+        return (0, True)
+
+    def get_manifest_hash(self, states, pins):
+        manifest = json.dumps(
+            {"states": states, "pins": pins, "git": self.git}, sort_keys=True
+        )
+        return hashlib.sha256(manifest.encode("utf-8")).hexdigest()
+
+    def is_stamp_fresh(self, manifest, states, pins):
+        """
+        whether the same manifest was applied to the same installed packages,
+        packages in latest state are rechecked after outdated_cache_ttl
+        """
+        if self.module.params["force_refresh"]:
+            return False
+
+        stamp = self.read_state("stamp.json")
+        index = self.get_package_index()
+        if not stamp or index is None:
+            return False
+        if stamp.get("manifest") != manifest:
+            return False
+        if stamp.get("fingerprint") != self.get_fingerprint(index):
+            return False
+
+        if any(s == "latest" and n not in pins for n, s in states.items()):
+            ttl = self.module.params["outdated_cache_ttl"]
+            return 0 <= time.time() - stamp.get("time", 0) < ttl
+
+        return True
+
+    def write_stamp(self, manifest):
+        index = self.get_package_index()
+
+        if index is not None:
+            self.write_state(
+                "stamp.json",
+                {
+                    "manifest": manifest,
+                    "fingerprint": self.get_fingerprint(index),
+                    "time": time.time(),
+                },
+            )
+
+    def plan_packages(self, states, pins=None):
+        """
+        plan actions for packages from a snapshot of installed and outdated
+        packages without changing anything, returns action -> list of
+        {name, from, to}
+        """
+        plan = {"install": [], "upgrade": [], "uninstall": []}
+        pins = pins or {}
+        rc, installed = self.get_installed_packages()
+        if rc != 0:
+            return (rc, plan)
+
+        outdated = {}
+        names = [
+            n
+            for n, s in states.items()
+            if s == "latest" and n in installed and n not in pins and n not in self.git
+        ]
+        if names:
+            rc, outdated = self.get_outdated_packages(names)
+            if rc != 0:
+                return (rc, plan)
+
+        for name, state in states.items():
+            version = installed.get(name)
+            if state == "absent":
+                if name in installed:
+                    plan["uninstall"].append(
+                        {"name": name, "from": version, "to": None}
+                    )
+            elif name in self.git:
+                rc, package = self.plan_git_package(name, state, pins.get(name))
+                if rc != 0:
+                    return (rc, plan)
+                if package:
+                    plan["upgrade" if package["from"] else "install"].append(package)
+            elif name in pins:
+                if version != pins[name]:
+                    plan["install"].append(
+                        {"name": name, "from": version, "to": pins[name]}
+                    )
+            elif name not in installed:
+                plan["install"].append({"name": name, "from": None, "to": None})
+            elif state == "latest" and name in outdated:
+                plan["upgrade"].append(
+                    {"name": name, "from": version, "to": outdated[name]}
+                )
+
+        return (rc, plan)
+
+    def get_diff(self, plan):
+        before, after = ([], [])
+
+        for action in ("install", "upgrade", "uninstall"):
+            for package in plan[action]:
+                if package["from"] is not None:
+                    before.append("{0}@{1}\n".format(package["name"], package["from"]))
+                if action != "uninstall":
+                    to = package["to"] or "latest"
+                    after.append("{0}@{1}\n".format(package["name"], to))
+
+        return {"before": "".join(sorted(before)), "after": "".join(sorted(after))}
+
+    def packages_apply(self, packages):
+        rc, changed, outputs = (0, False, [])
+        states = self.get_states(packages)
+        self.git = self.get_git_packages(packages)
+        self.results = [
+            {"name": n, "state": s, "action": None, "changed": False, "duration": None}
+            for n, s in states.items()
+        ]
+
+        rc, pins = self.read_lockfile()
+        if rc != 0:
+            return (rc, changed)
+
+        # config.cson is checked on every run because it is also changed
+        # from atom, disabled and enabled packages are present otherwise
+        rc, toggled = self.toggle_packages(states)
+        if rc != 0:
+            return (rc, changed)
+        changed = any(toggled.values())
+        for result in self.results:
+            for action, names in toggled.items():
+                if result["name"] in names:
+                    result["action"] = action
+                    result["changed"] = True
+
+        # nothing to do when the same manifest is applied to the same
+        # packages, this doesn't start apm at all
+        manifest = self.get_manifest_hash(states, pins)
+        fresh = self.is_stamp_fresh(manifest, states, pins)
+        self.count_cache("stamp", fresh)
+        if fresh:
+            return (rc, changed)
+
+        rc, plan = self.plan_packages(states, pins)
+        if rc != 0:
+            return (rc, changed)
+
+        actions, targets = ({}, {})
+        for action, planned in plan.items():
+            actions[action] = [package["name"] for package in planned]
+            for package in planned:
+                targets[package["name"]] = package["name"]
+                if action == "install" and package["to"]:
+                    targets[package["name"]] = "{name}@{to}".format(**package)
+
+        staging_directory, staged, fast = (None, {}, [])
+        if (
+            self.module.params["artifact_cache"]
+            or self.module.params["package_store"]
+            or self.git
+        ):
+            staging_directory = self.make_staging_directory()
+
+        # packages from git are checked out from their mirrors
+        for package in plan["install"] + plan["upgrade"]:
+            if package["name"] not in self.git:
+                continue
+            rc, path = self.stage_git_package(
+                package["name"], package["to"], staging_directory
+            )
+            if rc != 0:
+                shutil.rmtree(staging_directory, ignore_errors=True)
+                return (rc, changed)
+            staged[package["name"]] = path
+
+        # packages found in the shared store are linked into place, and
+        # they skip apm entirely
+        if self.module.params["package_store"]:
+            for package in plan["install"] + plan["upgrade"]:
+                if package["name"] in staged:
+                    continue
+                path = self.materialize_package(
+                    package["name"], package["to"], staging_directory
+                )
+                if path:
+                    staged[package["name"]] = path
+                    fast.append(package["name"])
+
+        if self.module.params["artifact_cache"]:
+            for package in plan["install"] + plan["upgrade"]:
+                if package["name"] in staged:
+                    continue
+                rc, path = self.stage_package(
+                    package["name"], package["to"], staging_directory
+                )
+                if rc != 0:
+                    shutil.rmtree(staging_directory, ignore_errors=True)
+                    return (rc, changed)
+                if path:
+                    staged[package["name"]] = path
+
+        commands = [
+            ("install", "apm install {0} --color=false"),
+            ("upgrade", "apm upgrade {0} --confirm=false --color=false"),
+            ("uninstall", "apm uninstall {0} --color=false"),
+        ]
+        workers = self.module.params["workers"]
+        trash = self.module.params["uninstall_mode"] == "trash"
+        jobs = []
+        for action, command in commands:
+            # packages extracted from the artifact cache only need their
+            # dependencies to be installed
+            names = [n for n in actions[action] if n not in staged]
+            if action == "uninstall" and trash:
+                continue
+            jobs.extend(
+                ([n], "apm install --color=false", staged[n])
+                for n in actions[action]
+                if n in staged and n not in fast
+            )
+            if workers > 1 and action != "uninstall":
+                jobs.extend(([n], command.format(targets[n]), None) for n in names)
+            elif names:
+                jobs.append(
+                    (names, command.format(" ".join(targets[n] for n in names)), None)
+                )
+
+        durations = {}
+        with self.phase("apply"):
+            for name in fast:
+                started = time.time()
+                rc = rc or self.replace_package(name, staged[name])
+                durations[name] = round(time.time() - started, 3)
+                changed = True
+
+            if rc == 0 and trash and actions["uninstall"]:
+                started = time.time()
+                rc = self.trash_packages(actions["uninstall"])
+                durations.update(
+                    (name, round(time.time() - started, 3))
+                    for name in actions["uninstall"]
+                )
+                changed = True
+
+            if rc != 0:
+                jobs = []
+            if workers > 1:
+                commands = [(command, cwd) for names, command, cwd in jobs]
+                outcomes = self.run_parallel(commands, workers)
+            else:
+                outcomes = []
+                for names, command, cwd in jobs:
+                    if rc != 0:
+                        break
+                    started = time.time()
+                    if cwd:
+                        rc, stdout, stderr = self.run_command(command, cwd=cwd)
+                    else:
+                        rc, stdout, stderr = self.run_command(command)
+                    outcomes.append((rc, stdout, stderr, time.time() - started))
+
+            for (names, command, cwd), outcome in zip(jobs, outcomes):
+                if outcome[0] == 0 and cwd:
+                    outcome = (self.replace_package(names[0], cwd),) + outcome[1:]
+                if rc == 0:
+                    rc = outcome[0]
+                outputs.append(outcome[1:3])
+                durations.update((name, round(outcome[3], 3)) for name in names)
+                changed = True
+
+        if staging_directory:
+            shutil.rmtree(staging_directory, ignore_errors=True)
+
+        if rc == 0 and self.module.params["package_store"]:
+            self.update_store(actions)
+        if rc == 0:
+            self.record_abi(
+                actions["install"] + actions["upgrade"] + actions["uninstall"]
+            )
+
+        for result in self.results:
+            for action, names in actions.items():
+                if result["name"] in names:
+                    result["action"] = action
+                    result["changed"] = True
+            result["duration"] = durations.get(result["name"])
+
+        self.stdout = "\n".join(out for out, err in outputs if out)
+        self.stderr = "\n".join(err for out, err in outputs if err)
+
+        if rc == 0:
+            rc, updated = self.write_lockfile(states)
+            changed = changed or updated
+        if rc == 0:
+            self.write_stamp(manifest)
+
+        return (rc, changed)
+
+    def read_config(self):
+        return read_config(self.atom_home)
+
+    def get_disabled_packages(self, config):
+        return get_disabled_packages(config)
+
+    def set_disabled_packages(self, config, packages):
+        """
+        returns config.cson with core.disabledPackages replaced by packages,
+        core and the global scope are added when they don't exist
+        """
+        _, matched = self.get_disabled_packages(config)
+
+        def format(indent, step):
+            items = "".join('{0}{1}"{2}"\n'.format(indent, step, p) for p in packages)
+            return "{0}disabledPackages: [\n{1}{0}]".format(indent, items)
+
+        scope, core, _ = find_core(config)
+        if matched:
+            start, end = matched.span()
+            block = format(matched.group(1), "  ")
+        elif core:
+            start = end = core.end()
+            block = format(core.group(1) * 2, core.group(1)) + "\n"
+        elif scope:
+            start = end = scope.end()
+            block = "  core:\n" + format("    ", "  ") + "\n"
+        else:
+            if config and not config.endswith("\n"):
+                config += "\n"
+            start = end = len(config)
+            block = '"*":\n  core:\n' + format("    ", "  ") + "\n"
+
+        return config[:start] + block + config[end:]
+
+    def toggle_packages(self, states):
+        """
+        add packages in disabled state to and remove packages in enabled
+        state from core.disabledPackages of config.cson in a single atomic
+        replace, returns action -> names of toggled packages
+        """
+        toggled = {"disable": [], "enable": []}
+        config = self.read_config()
+        disabled, _ = self.get_disabled_packages(config)
+
+        for name, state in states.items():
+            if state == "disabled" and name not in disabled:
+                toggled["disable"].append(name)
+            elif state == "enabled" and name in disabled:
+                toggled["enable"].append(name)
+
+        if not any(toggled.values()) or self.module.check_mode:
+            return (0, toggled)
+
+        packages = [n for n in disabled if n not in toggled["enable"]]
+        packages.extend(toggled["disable"])
+        path = os.path.join(self.atom_home, "config.cson")
+        try:
+            os.makedirs(self.atom_home, exist_ok=True)
+            fd, temporary = tempfile.mkstemp(dir=self.atom_home, prefix=".config")
+            with os.fdopen(fd, "w") as f:
+                f.write(self.set_disabled_packages(config, packages))
+            if os.path.exists(path):
+                shutil.copymode(path, temporary)
+            os.replace(temporary, path)
+        except OSError as e:
+            self.stderr = "failed to write {0}: {1}".format(path, to_native(e))
+            return (1, toggled)
+
+        return (0, toggled)
+
+    def get_git_commit(self, name):
+        """
+        returns the commit of the package installed from git, that is
+        recorded in package.json like apm does
+        """
+        path = os.path.join(self.atom_home, "packages", name, "package.json")
+        try:
+            with open(path) as f:
+                source = json.load(f).get("apmInstallSource") or {}
+            return source.get("sha") if source.get("type") == "git" else None
+        except (OSError, ValueError, AttributeError):
+            return None
+
+    def get_git_mirror(self, repo):
+        key = hashlib.sha256(repo.encode("utf-8")).hexdigest()
+        return os.path.join(self.atom_home, STATE_DIRECTORY, "git", key + ".git")
+
+    def resolve_git_commit(self, repo, version, fetch):
+        """
+        returns the commit of version in the bare mirror of repo, the
+        mirror is created or fetched incrementally when version is not in
+        it or fetch is true
+        """
+        mirror = self.get_git_mirror(repo)
+        command = "git rev-parse --verify --quiet {0}".format(
+            shlex.quote("{0}^{{commit}}".format(version or "HEAD"))
+        )
+
+        if not fetch and os.path.isdir(mirror):
+            rc, stdout, stderr = self.run_command(command, cwd=mirror)
+            self.count_cache("git", rc == 0)
+            if rc == 0:
+                return (0, stdout.strip())
+        else:
+            self.count_cache("git", False)
+
+        # the mirror is not changed in check mode
+        if self.module.check_mode:
+            return self.resolve_remote_commit(repo, version)
+
+        if os.path.isdir(mirror):
+            rc, stdout, stderr = self.run_command(
+                "git fetch --prune --quiet origin", cwd=mirror
+            )
+        else:
+            # the mirror is cloned next to its final path and renamed, so
+            # that an interrupted clone is never used
+            try:
+                os.makedirs(os.path.dirname(mirror), exist_ok=True)
+                temporary = tempfile.mkdtemp(
+                    dir=os.path.dirname(mirror), prefix=".clone"
+                )
+            except OSError as e:
+                self.stderr = "failed to create the mirror of {0}: {1}".format(
+                    repo, to_native(e)
+                )
+                return (1, None)
+            rc, stdout, stderr = self.run_command(
+                "git clone --mirror --quiet {0} {1}".format(
+                    shlex.quote(repo), shlex.quote(temporary)
+                )
+            )
+            if rc == 0:
+                # shallow clones fetch a single commit from the mirror
+                rc, stdout, stderr = self.run_command(
+                    "git config uploadpack.allowAnySHA1InWant true", cwd=temporary
+                )
+            if rc == 0:
+                try:
+                    os.rename(temporary, mirror)
+                except OSError as e:
+                    rc = 1
+                    stderr = "failed to create the mirror of {0}: {1}".format(
+                        repo, to_native(e)
+                    )
+            if rc != 0:
+                shutil.rmtree(temporary, ignore_errors=True)
+        if rc == 0:
+            rc, stdout, stderr = self.run_command(command, cwd=mirror)
+            if rc != 0:
+                stderr = "{0} is not found in {1}".format(version or "HEAD", repo)
+
+        self.stdout, self.stderr = stdout, stderr
+        return (rc, stdout.strip() if rc == 0 else None)
+
+    def resolve_remote_commit(self, repo, version):
+        """
+        returns the commit of version by `git ls-remote` without a mirror,
+        or None when version is not a full commit, a branch or a tag
+        """
+        if version and COMMIT_PATTERN.match(version):
+            return (0, version)
+
+        refs = [version, version + "^{}"] if version else ["HEAD"]
+        rc, stdout, stderr = self.run_command(
+            "git ls-remote {0} {1}".format(
+                shlex.quote(repo), " ".join(shlex.quote(ref) for ref in refs)
+            )
+        )
+        if rc != 0:
+            self.stdout, self.stderr = stdout, stderr
+            return (rc, None)
+
+        # annotated tags are peeled to their commits
+        commits = [line.split("\t") for line in stdout.splitlines() if "\t" in line]
+        commits.sort(key=lambda item: not item[1].endswith("^{}"))
+        return (0, commits[0][0] if commits else None)
+
+    def plan_git_package(self, name, state, pin=None):
+        """
+        returns {name, from, to} when the package from git is not installed
+        at the commit of its version, or None
+        """
+        repo, version = self.git[name]["repo"], pin or self.git[name]["version"]
+        current = self.get_git_commit(name)
+
+        # nothing is fetched when the installed commit is pinned
+        if current and state != "latest" and current == version:
+            return (0, None)
+
+        fetch = state == "latest" and not (version and COMMIT_PATTERN.match(version))
+        rc, commit = self.resolve_git_commit(repo, version, fetch)
+        if rc != 0:
+            return (rc, None)
+        if commit and commit == current:
+            return (0, None)
+
+        # a version that is unknown without the mirror would be installed
+        return (0, {"name": name, "from": current, "to": commit or version})
+
+    def stage_git_package(self, name, commit, staging_directory):
+        """
+        check out commit of the package from its mirror by a shallow clone
+        of the single commit, returns path of the checked out package
+        """
+        repo = self.git[name]["repo"]
+        destination = os.path.join(staging_directory, name)
+        commands = [
+            ("git init --quiet {0}".format(shlex.quote(destination)), None),
+            (
+                "git fetch --quiet --depth 1 {0} {1}".format(
+                    shlex.quote("file://" + self.get_git_mirror(repo)), commit
+                ),
+                destination,
+            ),
+            ("git checkout --quiet FETCH_HEAD", destination),
+        ]
+
+        for command, cwd in commands:
+            rc, stdout, stderr = self.run_command(command, cwd=cwd)
+            if rc != 0:
+                self.stdout, self.stderr = stdout, stderr
+                return (rc, None)
+
+        try:
+            shutil.rmtree(os.path.join(destination, ".git"))
+            manifest_path = os.path.join(destination, "package.json")
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            manifest["apmInstallSource"] = {
+                "type": "git",
+                "source": repo,
+                "sha": commit,
+            }
+            with open(manifest_path, "w") as f:
+                json.dump(manifest, f, indent=2)
+        except (OSError, ValueError, TypeError) as e:
+            self.stderr = "invalid package {0}: {1}".format(repo, to_native(e))
+            return (1, None)
+
+        return (0, destination)
+
+    def get_registry_metadata(self, name):
+        url = "{0}/packages/{1}".format(
+            self.module.params["registry_url"].rstrip("/"), quote(name)
+        )
+
+        try:
+            response = open_url(url, timeout=REGISTRY_TIMEOUT)
+            return (0, url, json.loads(to_native(response.read())))
+        except Exception as e:
+            self.stderr = "failed to get {0}: {1}".format(url, to_native(e))
+            return (1, url, {})
+
+    def get_registry_outdated(self, names):
+        """
+        returns name -> latest version of installed packages in names that
+        are outdated, asking the registry only for them. responses are
+        revalidated by ETag and reused within outdated_cache_ttl
+        """
+        rc, installed = self.get_installed_packages()
+        if rc != 0:
+            return (rc, {})
+
+        ttl = self.module.params["outdated_cache_ttl"]
+        force = self.module.params["force_refresh"]
+        cache = self.read_state("registry.json") or {}
+        now = time.time()
+        pending = []
+
+        for name in names:
+            entry = cache.get(name) or {}
+            hit = not force and 0 <= now - entry.get("time", 0) < ttl
+            self.count_cache("registry", hit)
+            if not hit:
+                pending.append(name)
+
+        if pending:
+            rc, responses = self.request_packages(pending, cache)
+            if rc != 0:
+                return (rc, {})
+            for name, (status, headers, body) in responses.items():
+                entry = dict(cache.get(name) or {}, time=now)
+                if status == 200:
+                    try:
+                        metadata = json.loads(to_native(body))
+                        entry["latest"] = metadata["releases"]["latest"]
+                    except (ValueError, KeyError, TypeError):
+                        self.stderr = "unexpected metadata of {0}".format(name)
+                        return (1, {})
+                    entry["etag"] = headers.get("ETag")
+                    entry["last_modified"] = headers.get("Last-Modified")
+                elif status == 404:
+                    # packages not in the registry, like git packages, are
+                    # never outdated
+                    entry = {"time": now, "latest": None}
+                elif status != 304:
+                    self.stderr = "failed to get {0}: HTTP {1}".format(name, status)
+                    return (1, {})
+                cache[name] = entry
+            self.write_state("registry.json", cache)
+
+        outdated = {}
+        for name in names:
+            latest = (cache.get(name) or {}).get("latest")
+            if name in installed and latest and latest != installed[name]:
+                outdated[name] = latest
+
+        return (rc, outdated)
+
+    def get_registry_proxy(self, url):
+        """
+        returns netloc and headers of the proxy for url from http_proxy and
+        https_proxy, or None when there is none or no_proxy matches the host
+        """
+        proxy = getproxies().get(url.scheme)
+        if not proxy or proxy_bypass(url.netloc):
+            return None
+
+        proxy = urlsplit(proxy if "://" in proxy else "http://" + proxy)
+        headers = {}
+        if proxy.username:
+            credentials = "{0}:{1}".format(
+                unquote(proxy.username), unquote(proxy.password or "")
+            )
+            headers["Proxy-Authorization"] = "Basic " + to_native(
+                base64.b64encode(credentials.encode("utf-8"))
+            )
+
+        return (proxy.netloc.rpartition("@")[2], headers)
+
+    def request_packages(self, names, cache):
+        """
+        GET metadata of packages over a pool of kept-alive connections,
+        returns name -> (status, headers, body)
+        """
+        url = urlsplit(self.module.params["registry_url"])
+        prefix = url.path.rstrip("/") + "/packages/"
+        proxy = self.get_registry_proxy(url)
+        if url.scheme == "https":
+            connection_class = http.client.HTTPSConnection
+        else:
+            connection_class = http.client.HTTPConnection
+
+        def connect():
+            if not proxy:
+                return connection_class(url.netloc, timeout=REGISTRY_TIMEOUT)
+            connection = connection_class(proxy[0], timeout=REGISTRY_TIMEOUT)
+            # https is tunneled by CONNECT, and http is requested from the
+            # proxy by absolute urls
+            if url.scheme == "https":
+                connection.set_tunnel(url.netloc, headers=proxy[1])
+            return connection
+
+        if proxy and url.scheme != "https":
+            prefix = "{0}://{1}{2}".format(url.scheme, url.netloc, prefix)
+
+        size = max(1, min(self.module.params["registry_connections"], len(names)))
+        pool = Queue()
+        for _ in range(size):
+            pool.put(connect())
+
+        def request(name):
+            entry = cache.get(name) or {}
+            headers = {"Accept": "application/json"}
+            if proxy and url.scheme != "https":
+                headers.update(proxy[1])
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+            connection = pool.get()
+            try:
+                # the server may close an idle connection, which is retried
+                # once on a new connection
+                for retry in (False, True):
+                    try:
+                        connection.request("GET", prefix + quote(name), None, headers)
+                        response = connection.getresponse()
+                        body = response.read()
+                        return (response.status, response.msg, body)
+                    except (OSError, http.client.HTTPException):
+                        connection.close()
+                        if retry:
+                            raise
+            finally:
+                pool.put(connection)
+
+        try:
+            with ThreadPoolExecutor(max_workers=size) as executor:
+                responses = dict(zip(names, executor.map(request, names)))
+        except (OSError, http.client.HTTPException) as e:
+            self.stderr = "failed to get {0}: {1}".format(
+                self.module.params["registry_url"], to_native(e)
+            )
+            return (1, {})
+        finally:
+            while not pool.empty():
+                pool.get().close()
+
+        return (0, responses)
+
+    def get_artifact_paths(self, name, version):
+        cache = self.module.params["artifact_cache"]
+        key = "{0}@{1}".format(name, version).encode("utf-8")
+        return (
+            os.path.join(cache, "index", hashlib.sha256(key).hexdigest() + ".json"),
+            os.path.join(cache, "blobs"),
+        )
+
+    @timed("artifacts")
+    def fetch_artifact(self, name, version=None):
+        """
+        returns path of the tarball of name@version in the artifact cache,
+        the tarball is downloaded from the registry when it is not cached,
+        latest version is used when version is None
+        """
+        if version is not None:
+            index_path, blobs = self.get_artifact_paths(name, version)
+            try:
+                with open(index_path) as f:
+                    digest = json.load(f)["sha256"]
+                path = os.path.join(blobs, digest[:2], digest + ".tgz")
+                os.utime(path)
+                self.count_cache("artifact", True)
+                return (0, version, path)
+            except (OSError, ValueError, KeyError, TypeError):
+                pass
+
+        self.count_cache("artifact", False)
+        rc, url, metadata = self.get_registry_metadata(name)
+        if rc != 0:
+            return (rc, version, None)
+
+        try:
+            version = version or metadata["releases"]["latest"]
+            dist = metadata.get("versions", {}).get(version, {}).get("dist", {})
+        except (KeyError, TypeError, AttributeError):
+            self.stderr = "unexpected metadata of {0}".format(name)
+            return (1, version, None)
+
+        tarball = urljoin(
+            url, dist.get("tarball") or "{0}/versions/{1}/tarball".format(name, version)
+        )
+        try:
+            response = open_url(tarball, timeout=REGISTRY_TIMEOUT)
+        except Exception as e:
+            self.stderr = "failed to fetch {0}: {1}".format(tarball, to_native(e))
+            return (1, version, None)
+
+        # the package is installed by apm when the tarball can't be cached
+        index_path, blobs = self.get_artifact_paths(name, version)
+        temporaries = []
+        try:
+            self.make_artifact_directory(os.path.dirname(index_path))
+            self.make_artifact_directory(blobs)
+            digest, size = (hashlib.sha256(), 0)
+            fd, temporary = tempfile.mkstemp(dir=blobs, prefix=".download")
+            temporaries.append(temporary)
+            with os.fdopen(fd, "wb") as f:
+                for chunk in iter(lambda: response.read(READ_SIZE), b""):
+                    digest.update(chunk)
+                    size += len(chunk)
+                    f.write(chunk)
+            digest = digest.hexdigest()
+            path = os.path.join(blobs, digest[:2], digest + ".tgz")
+            self.make_artifact_directory(os.path.dirname(path))
+            os.chmod(temporary, ARTIFACT_MODE)
+            os.replace(temporary, path)
+
+            fd, temporary = tempfile.mkstemp(
+                dir=os.path.dirname(index_path), prefix=".index"
+            )
+            temporaries.append(temporary)
+            with os.fdopen(fd, "w") as f:
+                json.dump(
+                    {"name": name, "version": version, "sha256": digest, "size": size},
+                    f,
+                )
+            os.chmod(temporary, ARTIFACT_MODE)
+            os.replace(temporary, index_path)
+        except Exception as e:
+            for temporary in temporaries:
+                try:
+                    os.remove(temporary)
+                except OSError:
+                    pass
+            self.module.warn("failed to cache {0}: {1}".format(tarball, to_native(e)))
+            return (0, version, None)
+
+        self.evict_artifacts(self.module.params["artifact_cache_max_size"] << 20, path)
+        return (0, version, path)
+
+    def make_artifact_directory(self, path):
+        """
+        create path and its parents in the artifact cache writable by the
+        group, directories inherit the group of the cache by setgid so that
+        users of the group share the cache
+        """
+        cache = os.path.abspath(self.module.params["artifact_cache"])
+        path = os.path.abspath(path)
+        os.makedirs(os.path.dirname(cache), exist_ok=True)
+
+        directories = [cache]
+        for part in os.path.relpath(path, cache).split(os.sep):
+            if part != os.curdir:
+                directories.append(os.path.join(directories[-1], part))
+
+        for directory in directories:
+            try:
+                os.mkdir(directory)
+            except FileExistsError:
+                continue
+            os.chmod(directory, ARTIFACT_DIRECTORY_MODE)
+
+    def evict_artifacts(self, max_size, keep=None):
+        """
+        remove least recently used tarballs until the artifact cache is
+        smaller than max_size bytes, index entries of removed tarballs
+        are treated as misses
+        """
+        blobs, total = ([], 0)
+        root = os.path.join(self.module.params["artifact_cache"], "blobs")
+
+        for directory, _, filenames in os.walk(root):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                blobs.append((stat.st_atime, stat.st_size, path))
+                total += stat.st_size
+
+        for atime, size, path in sorted(blobs):
+            if total <= max_size:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+    def make_staging_directory(self):
+        # staging directory is in ATOM_HOME so that packages can be moved
+        # into the packages directory atomically
+        root = os.path.join(self.atom_home, STATE_DIRECTORY, "staging")
+        os.makedirs(root, exist_ok=True)
+        return tempfile.mkdtemp(dir=root)
+
+    def stage_package(self, name, version, staging_directory):
+        """
+        extract the tarball of name@version from the artifact cache,
+        returns path of the extracted package
+        """
+        rc, version, artifact = self.fetch_artifact(name, version)
+        if rc != 0 or artifact is None:
+            return (rc, None)
+
+        destination = os.path.join(staging_directory, name)
+        try:
+            os.makedirs(destination, exist_ok=True)
+            root = os.path.realpath(destination)
+            with tarfile.open(artifact, "r:gz") as archive:
+                members = archive.getmembers()
+                # links are rejected, a link extracted before another member
+                # could redirect that member outside of the destination
+                for member in members:
+                    path = os.path.realpath(os.path.join(root, member.name))
+                    if os.path.commonpath([root, path]) != root or not (
+                        member.isfile() or member.isdir()
+                    ):
+                        raise tarfile.TarError("unsafe member " + member.name)
+                archive.extractall(destination, members)
+        except (OSError, tarfile.TarError) as e:
+            self.stderr = "failed to extract {0}: {1}".format(artifact, to_native(e))
+            return (1, None)
+
+        # tarballs of github and npm have a single top level directory
+        entries = os.listdir(destination)
+        if len(entries) == 1 and os.path.isdir(os.path.join(destination, entries[0])):
+            destination = os.path.join(destination, entries[0])
+
+        return (0, destination)
+
+    def replace_package(self, name, path):
+        """
+        move the package at path into the packages directory atomically,
+        returns rc
+        """
+        packages_directory = os.path.join(self.atom_home, "packages")
+        destination = os.path.join(packages_directory, name)
+        previous = None
+
+        try:
+            os.makedirs(packages_directory, exist_ok=True)
+            if os.path.lexists(destination):
+                previous = path + ".previous"
+                os.rename(destination, previous)
+            os.rename(path, destination)
+        except OSError as e:
+            self.stderr = "failed to install {0}: {1}".format(name, to_native(e))
+            return 1
+        finally:
+            if previous and os.path.lexists(previous):
+                if os.path.lexists(destination):
+                    shutil.rmtree(previous, ignore_errors=True)
+                else:
+                    os.rename(previous, destination)
+
+        return 0
+
+    def trash_packages(self, names):
+        """
+        move packages into the trash atomically and delete them in a
+        detached process, returns rc
+        """
+        root = os.path.join(self.atom_home, TRASH_DIRECTORY)
+        rc, trashed = (0, [])
+
+        for name in names:
+            try:
+                # every package gets its own directory in the trash, an empty
+                # one left by a crash is removed by purge_trash later
+                os.makedirs(root, exist_ok=True)
+                directory = tempfile.mkdtemp(dir=root, prefix=name + ".")
+                trashed.append(directory)
+                os.rename(
+                    os.path.join(self.atom_home, "packages", name),
+                    os.path.join(directory, name),
+                )
+            except OSError as e:
+                self.stderr = "failed to uninstall {0}: {1}".format(name, to_native(e))
+                rc = 1
+                break
+
+        if trashed:
+            self.delete_in_background(trashed)
+
+        return rc
+
+    def delete_in_background(self, paths):
+        """
+        start a process that outlives the module to delete paths
+        """
+        try:
+            subprocess.Popen(
+                [
+                    sys.executable,
+                    "-c",
+                    "import shutil, sys\n"
+                    "for path in sys.argv[1:]:\n"
+                    "    shutil.rmtree(path, ignore_errors=True)",
+                ]
+                + paths,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                close_fds=True,
+                start_new_session=True,
+            )
+        except OSError:
+            pass
+
+    def purge_trash(self, budget):
+        """
+        delete what is left in the trash by crashed or killed deletions,
+        stops after budget seconds and continues on the next run
+        """
+        root = os.path.join(self.atom_home, TRASH_DIRECTORY)
+        deadline = time.monotonic() + budget
+
+        try:
+            entries = sorted(os.listdir(root))
+        except OSError:
+            return
+
+        with self.phase("trash"):
+            for entry in entries:
+                path = os.path.join(root, entry)
+                for directory, directories, filenames in os.walk(path, topdown=False):
+                    if time.monotonic() >= deadline:
+                        return
+                    # symbolic links to directories are listed in directories
+                    # but they are removed like files
+                    links = [
+                        d
+                        for d in directories
+                        if os.path.islink(os.path.join(directory, d))
+                    ]
+                    for filename in filenames + links:
+                        try:
+                            os.unlink(os.path.join(directory, filename))
+                        except OSError:
+                            pass
+                    try:
+                        os.rmdir(directory)
+                    except OSError:
+                        pass
+
+    def get_electron_version(self):
+        """
+        returns the version of electron that packages with native modules
+        are built against, from electron_version, ATOM_ELECTRON_VERSION
+        or package.json in app.asar of the installed atom, or None
+        """
+        if self.electron_version is None:
+            version = self.module.params["electron_version"] or os.environ.get(
+                "ATOM_ELECTRON_VERSION"
+            )
+            for path in ATOM_ARCHIVES:
+                if version:
+                    break
+                try:
+                    manifest = json.loads(self.read_asar_file(path, "package.json"))
+                    version = manifest.get("electronVersion")
+                except (OSError, ValueError, KeyError, TypeError, struct.error):
+                    continue
+            self.electron_version = version or ""
+
+        return self.electron_version or None
+
+    def read_asar_file(self, path, name):
+        """
+        returns content of the file at name in the asar archive at path
+        """
+        with open(path, "rb") as f:
+            # the archive starts with pickled sizes of the header and of
+            # the json in the header, contents of files follow the header
+            _, header_size, _, json_size = struct.unpack("<4I", f.read(16))
+            header = json.loads(to_native(f.read(json_size)))
+            entry = header
+            for part in name.split("/"):
+                entry = entry["files"][part]
+            f.seek(8 + header_size + int(entry["offset"]))
+            return f.read(entry["size"])
+
+    def has_native_modules(self, path):
+        return has_native_modules(path)
+
+    def get_abi_key(self, stat):
+        # packages are replaced by install and upgrade, so a record is valid
+        # while the directory is the same
+        return "{0}:{1}".format(stat.st_ino, stat.st_mtime_ns)
+
+    def record_abi(self, names):
+        """
+        record the electron version that packages in names with native
+        modules are built against in $ATOM_HOME/.ansible-apm/abi.json
+        """
+        if not names:
+            return
+
+        records = self.read_state("abi.json") or {}
+
+        for name in names:
+            path = os.path.join(self.atom_home, "packages", name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                records.pop(name, None)
+                continue
+            native = self.has_native_modules(path)
+            records[name] = {
+                "key": self.get_abi_key(stat),
+                "native": native,
+                "electron": self.get_electron_version() if native else None,
+            }
+
+        self.write_state("abi.json", records)
+
+    def get_rebuild_packages(self):
+        """
+        returns installed packages with native modules that are built
+        against another electron version than the installed atom, packages
+        changed outside of the module are rebuilt when they are native
+        """
+        records = self.read_state("abi.json") or {}
+        electron_version = self.get_electron_version()
+        names = []
+
+        try:
+            with os.scandir(os.path.join(self.atom_home, "packages")) as entries:
+                for entry in entries:
+                    if entry.name.startswith(".") or not entry.is_dir():
+                        continue
+                    record = records.get(entry.name) or {}
+                    if record.get("key") == self.get_abi_key(entry.stat()):
+                        if record.get("native") and (
+                            record.get("electron") != electron_version
+                        ):
+                            names.append(entry.name)
+                    elif self.has_native_modules(entry.path):
+                        names.append(entry.name)
+        except OSError:
+            return []
+
+        return sorted(names)
+
+    def rebuild_packages(self):
+        """
+        run `apm rebuild` in packages to rebuild at most workers at a time,
+        returns rc
+        """
+        names = self.get_rebuild_packages()
+        if not names:
+            return 0
+
+        rc, outputs = (0, [])
+        commands = [
+            ("apm rebuild --color=false", os.path.join(self.atom_home, "packages", n))
+            for n in names
+        ]
+        with self.phase("rebuild"):
+            outcomes = self.run_parallel(commands, self.module.params["workers"])
+
+        for name, (code, stdout, stderr, duration) in zip(names, outcomes):
+            if code == 0:
+                self.rebuilt.append(name)
+            rc = rc or code
+            outputs.append((stdout, stderr))
+
+        self.record_abi(self.rebuilt)
+        self.stdout = "\n".join(filter(None, [self.stdout] + [o for o, e in outputs]))
+        self.stderr = "\n".join(filter(None, [self.stderr] + [e for o, e in outputs]))
+        return rc
+
+    def list_cache_entries(self):
+        """
+        returns entries of the caches of apm and node-gyp relative to
+        $ATOM_HOME, that are name/version of packages of npm before 5 and
+        headers of electron versions. @scope/name counts as a name, and
+        directories of npm like _cacache are not entries
+        """
+        entries = []
+
+        for root, depth in CACHE_ENTRIES:
+            paths = [root]
+            for _ in range(depth):
+                children = []
+                while paths:
+                    path = paths.pop()
+                    try:
+                        with os.scandir(os.path.join(self.atom_home, path)) as it:
+                            for entry in it:
+                                if entry.name.startswith((".", "_")) or not (
+                                    entry.is_dir(follow_symlinks=False)
+                                ):
+                                    continue
+                                if entry.name.startswith("@"):
+                                    paths.append(os.path.join(path, entry.name))
+                                else:
+                                    children.append(os.path.join(path, entry.name))
+                    except OSError:
+                        continue
+                paths = children
+            entries.extend(paths)
+
+        return entries
+
+    def read_cacache_bucket(self, path):
+        """
+        returns the last entry of an index bucket of cacache, that is lines
+        of the sha1 of json and the json, or None when the key is removed
+        """
+        entry = None
+
+        try:
+            with open(path) as f:
+                for line in f:
+                    digest, separator, data = line.rstrip("\n").partition("\t")
+                    if not separator:
+                        continue
+                    if hashlib.sha1(data.encode("utf-8")).hexdigest() != digest:
+                        continue
+                    entry = json.loads(data)
+        except (OSError, ValueError):
+            return None
+
+        if not isinstance(entry, dict) or not entry.get("integrity"):
+            return None
+        return entry
+
+    def get_cacache_content_paths(self, integrity):
+        """
+        returns paths relative to _cacache of the content of an integrity
+        """
+        paths = []
+
+        for item in str(integrity).split():
+            algorithm, separator, digest = item.partition("-")
+            try:
+                digest = base64.b64decode(digest.split("?")[0]).hex()
+            except ValueError:
+                continue
+            if separator and digest:
+                paths.append(
+                    os.path.join(
+                        "content-v2", algorithm, digest[:2], digest[2:4], digest[4:]
+                    )
+                )
+
+        return paths
+
+    def list_cacache_entries(self, recorded, directories):
+        """
+        returns path -> {mtime, atime, size, package, contents} of index
+        buckets of cacache that npm 5 and later keep in .apm/_cacache, and
+        mtimes of the directories of the index. package is the entry of npm
+        before 5 of tarballs, and contents are paths of its content. buckets
+        are only listed in directories whose mtime changed, and only read
+        when their own mtime changed
+        """
+        entries, mtimes = ({}, {})
+        children, buckets = ({}, {})
+        for path in directories:
+            children.setdefault(os.path.dirname(path), []).append(path)
+        for path, record in recorded.items():
+            buckets.setdefault(os.path.dirname(path), []).append((path, record))
+
+        # buckets are at index-v5/xx/yy/<rest of the hash>, so adding or
+        # removing one changes the mtime of its directory and of no other
+        pending = [(os.path.join(CACACHE, "index-v5"), 2)]
+        while pending:
+            path, depth = pending.pop()
+            directory = os.path.join(self.atom_home, path)
+            try:
+                mtime = os.stat(directory).st_mtime_ns
+            except OSError:
+                continue
+            if directories.get(path) == mtime:
+                mtimes[path] = mtime
+                if depth > 0:
+                    pending.extend((c, depth - 1) for c in children.get(path, []))
+                    continue
+                # records of old versions of the state have no contents
+                if all("contents" in record for _, record in buckets.get(path, [])):
+                    entries.update(buckets.get(path, []))
+                    continue
+
+            try:
+                with os.scandir(directory) as it:
+                    names = [
+                        (e.name, e.is_dir(follow_symlinks=False))
+                        for e in it
+                        if not e.name.startswith(".")
+                    ]
+            except OSError:
+                continue
+            # a directory that can't be listed is listed again next time
+            mtimes[path] = mtime
+            for name, is_dir in names:
+                if depth > 0 and is_dir:
+                    pending.append((os.path.join(path, name), depth - 1))
+                elif depth == 0 and not is_dir:
+                    self.read_cacache_entry(os.path.join(path, name), recorded, entries)
+
+        return (entries, mtimes)
+
+    def read_cacache_entry(self, path, recorded, entries):
+        """
+        add the index bucket at path to entries, it is taken from recorded
+        when its mtime is unchanged
+        """
+        bucket = os.path.join(self.atom_home, path)
+        try:
+            stat = os.stat(bucket)
+        except OSError:
+            return
+        record = recorded.get(path) or {}
+        if record.get("mtime") == stat.st_mtime_ns and "contents" in record:
+            entries[path] = record
+            return
+
+        entry = self.read_cacache_bucket(bucket)
+        if entry is None:
+            return
+        matched = TARBALL_PATTERN.search(entry.get("key") or "")
+        entries[path] = {
+            "mtime": stat.st_mtime_ns,
+            "atime": max(stat.st_atime, (entry.get("time") or 0) / 1000),
+            "size": entry.get("size") or 0,
+            "package": matched
+            and os.path.join(".apm", matched.group(1), matched.group(2)),
+            "contents": self.get_cacache_content_paths(entry["integrity"]),
+        }
+
+    def collect_cacache_contents(self, directory, paths):
+        """
+        move contents of cacache at paths relative to _cacache, that no
+        index bucket refers to any more, into directory, returns their size
+        """
+        root = os.path.join(self.atom_home, CACACHE)
+        size = 0
+
+        for relative in paths:
+            path = os.path.join(root, relative)
+            try:
+                size += os.lstat(path).st_size
+                destination = os.path.join(directory, relative)
+                os.makedirs(os.path.dirname(destination), exist_ok=True)
+                os.rename(path, destination)
+            except OSError:
+                continue
+
+        return size
+
+    def get_tree_size(self, path):
+        size = 0
+        for directory, _, filenames in os.walk(path):
+            for filename in filenames:
+                try:
+                    size += os.lstat(os.path.join(directory, filename)).st_size
+                except OSError:
+                    pass
+        return size
+
+    def get_protected_cache_entries(self, names, dependencies):
+        """
+        returns cache entries of installed versions of packages in names
+        and of their dependencies, and headers of the installed electron.
+        dependencies of packages are cached in dependencies by directory
+        """
+        protected = set()
+        electron_version = self.get_electron_version()
+        if electron_version:
+            protected.update(
+                os.path.join(root, electron_version)
+                for root, depth in CACHE_ENTRIES
+                if depth == 1
+            )
+
+        for name in names:
+            path = os.path.join(self.atom_home, "packages", name)
+            try:
+                key = self.get_abi_key(os.stat(path))
+            except OSError:
+                continue
+            record = dependencies.get(name) or {}
+            if record.get("key") != key:
+                record = {"key": key, "packages": self.list_dependencies(path)}
+                dependencies[name] = record
+            protected.update(os.path.join(".apm", *item) for item in record["packages"])
+
+        return protected
+
+    def list_dependencies(self, path):
+        """
+        returns [name, version] of the package at path and of the packages
+        in its node_modules
+        """
+        packages = []
+        manifests = [os.path.join(path, "package.json")]
+        modules = os.path.join(path, "node_modules")
+
+        try:
+            with os.scandir(modules) as entries:
+                for entry in entries:
+                    if entry.name.startswith("@"):
+                        with os.scandir(entry.path) as scoped:
+                            manifests.extend(
+                                os.path.join(e.path, "package.json") for e in scoped
+                            )
+                    elif not entry.name.startswith("."):
+                        manifests.append(os.path.join(entry.path, "package.json"))
+        except OSError:
+            pass
+
+        for manifest in manifests:
+            try:
+                with open(manifest) as f:
+                    data = json.load(f)
+                packages.append([data["name"], data["version"]])
+            except (OSError, ValueError, KeyError, TypeError):
+                continue
+
+        return packages
+
+    def prune_caches(self, names):
+        """
+        evict least recently used entries of the caches of apm and node-gyp
+        until they are smaller than cache_max_size megabytes. sizes of
+        entries are recorded and only entries changed since the last run
+        are walked. caches only grow by apm, so they are not walked at all
+        when no apm command ran and the recorded size fits
+        """
+        started = time.monotonic()
+        max_size = self.module.params["cache_max_size"] << 20
+        state = self.read_state("cache.json") or {}
+        recorded = state.get("entries") or {}
+        dependencies = state.get("dependencies") or {}
+        entries, total, trashed = ({}, 0, [])
+
+        if (
+            not self.metrics["commands"]
+            and state.get("total") is not None
+            and state["total"] <= max_size
+        ):
+            self.pruned = {
+                "size": state["total"],
+                "reclaimed": 0,
+                "evicted": 0,
+                "duration": round(time.monotonic() - started, 6),
+            }
+            return
+
+        with self.phase("prune"):
+            for path in self.list_cache_entries():
+                directory = os.path.join(self.atom_home, path)
+                try:
+                    stat = os.stat(directory)
+                    # reading a cached tarball updates its atime, not the
+                    # atime of the directory
+                    atime = max(
+                        [stat.st_atime]
+                        + [e.stat().st_atime for e in os.scandir(directory)]
+                    )
+                except OSError:
+                    continue
+                record = recorded.get(path) or {}
+                if record.get("mtime") == stat.st_mtime_ns:
+                    size = record["size"]
+                else:
+                    size = self.get_tree_size(directory)
+                entries[path] = {
+                    "mtime": stat.st_mtime_ns,
+                    "atime": atime,
+                    "size": size,
+                }
+                total += size
+
+            # tarballs in cacache are evicted by their index buckets, and
+            # the contents are collected after that
+            cacache, directories = self.list_cacache_entries(
+                recorded, state.get("directories") or {}
+            )
+            total += sum(entry["size"] for entry in cacache.values())
+            entries.update(cacache)
+
+            protected = self.get_protected_cache_entries(names, dependencies)
+            root = os.path.join(self.atom_home, TRASH_DIRECTORY)
+            reclaimed, evicted = (0, 0)
+            for path, entry in sorted(entries.items(), key=lambda i: i[1]["atime"]):
+                if total <= max_size:
+                    break
+                if path in protected or entry.get("package") in protected:
+                    continue
+                try:
+                    os.makedirs(root, exist_ok=True)
+                    directory = tempfile.mkdtemp(dir=root, prefix="cache.")
+                    trashed.append(directory)
+                    os.rename(
+                        os.path.join(self.atom_home, path),
+                        os.path.join(directory, os.path.basename(path)),
+                    )
+                except OSError:
+                    continue
+                total -= entry["size"]
+                reclaimed += entry["size"]
+                evicted += 1
+                del entries[path]
+
+            # only contents of evicted keys can be left without a key
+            contents = set()
+            for path, entry in cacache.items():
+                if path not in entries:
+                    contents.update(entry["contents"])
+            for path in cacache:
+                if path in entries:
+                    contents.difference_update(entries[path]["contents"])
+            if contents:
+                try:
+                    directory = tempfile.mkdtemp(dir=root, prefix="cache.")
+                    trashed.append(directory)
+                    self.collect_cacache_contents(directory, sorted(contents))
+                except OSError:
+                    pass
+
+            if trashed:
+                self.delete_in_background(trashed)
+            self.write_state(
+                "cache.json",
+                {
+                    "entries": entries,
+                    "directories": directories,
+                    "total": total,
+                    "dependencies": dict(
+                        (n, r) for n, r in dependencies.items() if n in names
+                    ),
+                },
+            )
+
+        self.pruned = {
+            "size": total,
+            "reclaimed": reclaimed,
+            "evicted": evicted,
+            "duration": round(time.monotonic() - started, 6),
+        }
+
+    def get_store_key(self, name, version, electron_version=None):
+        """
+        returns the key of name@version in the package store, packages with
+        native modules are also keyed by the electron version
+        """
+        key = "{0}@{1}".format(name, version)
+        if electron_version:
+            key += "+electron-{0}".format(electron_version)
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def get_store_reference(self):
+        # profiles are referred by the real path of their atom home
+        path = os.path.realpath(self.atom_home).encode("utf-8")
+        return hashlib.sha256(path).hexdigest()
+
+    @contextmanager
+    def lock_store(self):
+        store = self.module.params["package_store"]
+        os.makedirs(store, exist_ok=True)
+        with open(os.path.join(store, ".lock"), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield store
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def link_file(self, source, destination):
+        """
+        hardlink or reflink source to destination by package_store_link,
+        and copy it when that is not supported
+        """
+        mode = self.module.params["package_store_link"]
+
+        if mode == "hardlink":
+            try:
+                os.link(source, destination)
+                return
+            except OSError:
+                pass
+        elif mode == "reflink":
+            try:
+                with open(source, "rb") as src, open(destination, "wb") as dst:
+                    fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                shutil.copystat(source, destination)
+                return
+            except OSError:
+                pass
+
+        shutil.copy2(source, destination)
+
+    def link_tree(self, source, destination):
+        for directory, directories, filenames in os.walk(source):
+            target = os.path.join(destination, os.path.relpath(directory, source))
+            os.makedirs(target, exist_ok=True)
+            for name in directories + filenames:
+                path = os.path.join(directory, name)
+                if os.path.islink(path):
+                    os.symlink(os.readlink(path), os.path.join(target, name))
+                elif name in filenames:
+                    self.link_file(path, os.path.join(target, name))
+
+    def materialize_package(self, name, version, staging_directory):
+        """
+        link name@version from the package store into the staging
+        directory, returns the path or None when it is not in the store
+        """
+        if version is None:
+            rc, url, metadata = self.get_registry_metadata(name)
+            try:
+                version = metadata["releases"]["latest"]
+            except (KeyError, TypeError):
+                self.count_cache("store", False)
+                return None
+
+        electron_version = self.get_electron_version()
+        keys = [self.get_store_key(name, version)]
+        if electron_version:
+            keys.append(self.get_store_key(name, version, electron_version))
+
+        store = self.module.params["package_store"]
+        destination = os.path.join(staging_directory, name)
+        for key in keys:
+            source = os.path.join(store, key, "package")
+            if not os.path.isdir(source):
+                continue
+            try:
+                self.link_tree(source, destination)
+            except OSError:
+                # the entry was removed by another profile meanwhile
+                shutil.rmtree(destination, ignore_errors=True)
+                break
+            self.count_cache("store", True)
+            return destination
+
+        self.count_cache("store", False)
+        return None
+
+    def update_store(self, actions):
+        """
+        add installed and upgraded packages to the package store and
+        release uninstalled ones, entries that no profile refers to are
+        removed
+        """
+        records = self.read_state("store.json") or {}
+        reference = self.get_store_reference()
+
+        try:
+            with self.lock_store() as store:
+                for name in actions["install"] + actions["upgrade"]:
+                    # packages from git are keyed by commit, not by version
+                    if name in self.git:
+                        if name in records:
+                            self.release_entry(store, records.pop(name), reference)
+                        continue
+                    key = self.publish_package(store, name, reference)
+                    if key and records.get(name) not in (None, key):
+                        self.release_entry(store, records[name], reference)
+                    if key:
+                        records[name] = key
+                for name in actions["uninstall"]:
+                    if name in records:
+                        self.release_entry(store, records.pop(name), reference)
+        except OSError:
+            pass
+
+        self.write_state("store.json", records)
+
+    def publish_package(self, store, name, reference):
+        """
+        add the installed package to the store unless it is there, and
+        refer to it from this profile, returns the key
+        """
+        path = os.path.join(self.atom_home, "packages", name)
+        try:
+            with open(os.path.join(path, "package.json")) as f:
+                version = json.load(f)["version"]
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+        electron_version = None
+        if self.has_native_modules(path):
+            electron_version = self.get_electron_version()
+            if not electron_version:
+                return None
+
+        key = self.get_store_key(name, version, electron_version)
+        entry = os.path.join(store, key)
+        if not os.path.isdir(entry):
+            temporary = tempfile.mkdtemp(dir=store, prefix=".publish")
+            try:
+                self.link_tree(path, os.path.join(temporary, "package"))
+                os.makedirs(os.path.join(temporary, "references"))
+                with open(os.path.join(temporary, "manifest.json"), "w") as f:
+                    json.dump(
+                        {
+                            "name": name,
+                            "version": version,
+                            "electron": electron_version,
+                        },
+                        f,
+                    )
+                os.rename(temporary, entry)
+            except OSError:
+                shutil.rmtree(temporary, ignore_errors=True)
+                return None
+
+        with open(os.path.join(entry, "references", reference), "w") as f:
+            f.write(self.atom_home)
+
+        return key
+
+    def release_entry(self, store, key, reference):
+        entry = os.path.join(store, key)
+        references = os.path.join(entry, "references")
+
+        try:
+            os.remove(os.path.join(references, reference))
+        except OSError:
+            pass
+
+        try:
+            if os.listdir(references):
+                return
+            removed = tempfile.mkdtemp(dir=store, prefix=".remove")
+            os.rename(entry, os.path.join(removed, key))
+        except OSError:
+            return
+        shutil.rmtree(removed, ignore_errors=True)
+
+    def get_timeout(self):
+        """
+        returns seconds that the next command can run, or None when both
+        timeout and deadline are not set
+        """
+        timeouts = []
+
+        if self.module.params["timeout"] > 0:
+            timeouts.append(self.module.params["timeout"])
+        if self.deadline is not None:
+            timeouts.append(self.deadline - time.monotonic())
+
+        return min(timeouts) if timeouts else None
+
+    async def execute(self, command, environ_update=None, cwd=None):
+        """
+        run a command in its own process group, output is read
+        incrementally and the whole process group is terminated when
+        the timeout or the deadline is exceeded
+        """
+        started = time.monotonic()
+        timeout = self.get_timeout()
+
+        metric = {"command": command, "rc": None, "duration": 0.0, "output_bytes": 0}
+        self.metrics["commands"].append(metric)
+
+        if timeout is not None and timeout <= 0:
+            self.timed_out.append(command)
+            metric["rc"] = TIMEOUT_RC
+            return (TIMEOUT_RC, "", "deadline exceeded before start", 0.0)
+
+        rc, stdout, stderr, timed_out = await execute(
+            command,
+            dict(os.environ, ATOM_HOME=self.atom_home, **(environ_update or {})),
+            cwd,
+            timeout,
+        )
+        if timed_out:
+            self.timed_out.append(command)
+
+        duration = time.monotonic() - started
+        metric.update(
+            rc=rc, duration=round(duration, 6), output_bytes=len(stdout) + len(stderr)
+        )
+        self.metrics["output_bytes"] += metric["output_bytes"]
+        return (
+            rc,
+            to_native(stdout, errors="surrogate_or_replace"),
+            to_native(stderr, errors="surrogate_or_replace"),
+            duration,
+        )
+
+    def run_command(self, command, environ_update=None, cwd=None):
+        rc, stdout, stderr, duration = asyncio.run(
+            self.execute(command, environ_update, cwd)
+        )
+        return (rc, stdout, stderr)
+
+    def run_parallel(self, commands, workers):
+        """
+        run (command, cwd) at most workers at a time, each worker has its
+        own npm cache and temporary directory so that apm instances don't
+        share lock files
+        """
+
+        async def run_all(root):
+            directories = asyncio.Queue()
+            for number in range(workers):
+                directory = os.path.join(root, str(number))
+                os.makedirs(os.path.join(directory, "cache"))
+                os.makedirs(os.path.join(directory, "tmp"))
+                directories.put_nowait(directory)
+
+            async def run(command, cwd):
+                directory = await directories.get()
+                try:
+                    return await self.execute(
+                        command,
+                        {
+                            "npm_config_cache": os.path.join(directory, "cache"),
+                            "npm_config_tmp": os.path.join(directory, "tmp"),
+                            "TMPDIR": os.path.join(directory, "tmp"),
+                        },
+                        cwd,
+                    )
+                finally:
+                    directories.put_nowait(directory)
+
+            return await asyncio.gather(*[run(c, cwd) for c, cwd in commands])
+
+        with tempfile.TemporaryDirectory(prefix="ansible-apm-") as root:
+            return asyncio.run(run_all(root))
+
     def main(self):
         rc, changed = (0, False)
         is_check_mode = self.module.check_mode
+        name = self.module.params["name"]
+        state = self.module.params["state"]
+        packages = self.module.params["packages"]
+
+        # packages are only rebuilt without name and packages, so that
+        # the installed packages are left as they are
+        if packages is None and name is not None:
+            targets = [{"name": name, "state": state}]
+        else:
+            targets = packages or []
 
-        # skip processing when check_mode is yes
+        # only plan actions when check_mode is yes
         if is_check_mode:
-            self.module.exit_json(changed=False)
+            plan = {"install": [], "upgrade": [], "uninstall": []}
+            rc, pins = self.read_lockfile()
+            self.git = self.get_git_packages(targets)
+            if rc == 0 and targets:
+                rc, plan = self.plan_packages(self.get_states(targets), pins)
+            if rc == 0:
+                rc, toggled = self.toggle_packages(self.get_states(targets))
+                plan.update(toggled)
+            if rc == 0 and self.module.params["rebuild"]:
+                plan["rebuild"] = self.get_rebuild_packages()
+            if rc != 0:
+                self.module.fail_json(
+                    msg="error",
+                    rc=rc,
+                    stdout=self.stdout,
+                    stderr=self.stderr,
+                    metrics=self.get_metrics(),
+                )
+            self.module.exit_json(
+                changed=any(plan.values()),
+                plan=plan,
+                diff=self.get_diff(plan),
+                metrics=self.get_metrics(),
+            )
 
-        name = self.module.params["name"]
-        state = self.module.params["state"]
+        self.purge_trash(self.module.params["trash_purge_budget"])
 
-        if state == "present":
+        # a single package goes through the artifact cache and the package
+        # store like a batch of one package
+        if (
+            packages is None
+            and name is not None
+            and (
+                self.module.params["artifact_cache"]
+                or self.module.params["package_store"]
+            )
+        ):
+            packages = targets
+
+        if packages is not None:
+            rc, changed = self.packages_apply(packages)
+        elif name is None:
+            pass
+        elif state == "present":
             rc, changed = self.package_install(name)
-        if state == "latest":
+        elif state == "latest":
             rc, changed = self.package_upgrade(name)
-        if state == "absent":
+        elif state == "absent":
             rc, changed = self.package_uninstall(name)
+        elif state in ("disabled", "enabled"):
+            rc, changed = self.package_install(name)
+            if rc == 0:
+                rc, toggled = self.toggle_packages({name: state})
+                changed = changed or any(toggled.values())
+
+        # packages are rebuilt after they are converged, so that packages
+        # installed by this run are built only once
+        if rc == 0 and self.module.params["rebuild"]:
+            rc = self.rebuild_packages()
+            changed = changed or bool(self.rebuilt)
+
+        if rc == 0 and self.module.params["cache_max_size"] > 0:
+            self.prune_caches([p["name"] for p in targets])
 
         if rc == 0:
             self.module.exit_json(
-                changed=changed, rc=rc, stdout=self.stdout, stderr=self.stderr
+                changed=changed,
+                rc=rc,
+                stdout=self.stdout,
+                stderr=self.stderr,
+                results=self.results,
+                rebuilt=self.rebuilt,
+                pruned=self.pruned,
+                metrics=self.get_metrics(),
             )
         else:
+            msg = "error"
+            if self.timed_out:
+                msg = "command timed out: {0}".format(", ".join(self.timed_out))
             self.module.fail_json(
-                msg="error", rc=rc, stdout=self.stdout, stderr=self.stderr
+                msg=msg,
+                rc=rc,
+                stdout=self.stdout,
+                stderr=self.stderr,
+                results=self.results,
+                rebuilt=self.rebuilt,
+                timed_out=self.timed_out,
+                metrics=self.get_metrics(),
             )
 
 
+def run_module():
+    """
+    run the module, a cProfile file of the run is written to the path of
+    ANSIBLE_APM_PROFILE environment variable, or into it when it is a
+    directory
+    """
+    path = os.environ.get(PROFILE_ENVIRONMENT)
+
+    if not path:
+        apm = ApmModule()
+        apm.main()
+        return
+
+    if os.path.isdir(path):
+        path = os.path.join(path, "apm-{0}.prof".format(os.getpid()))
+
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+        apm = ApmModule()
+        apm.main()
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+
+
 if __name__ == "__main__":
-    apm = ApmModule()
-    apm.main()
+    run_module()
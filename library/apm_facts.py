@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+
+import asyncio
+import json
+import os
+import time
+
+from ansible.module_utils._text import to_native
+from ansible.module_utils.apm_common import (
+    execute,
+    get_disabled_packages,
+    get_fingerprint,
+    has_native_modules,
+    parse_outdated_packages,
+    read_config,
+    read_state,
+    scan_packages,
+    write_state,
+)
+from ansible.module_utils.basic import AnsibleModule
+
+
+class ApmFactsModule:
+    def __init__(self):
+        self.module = AnsibleModule(
+            argument_spec={
+                "atom_home": {"type": "path"},
+                "outdated": {"type": "bool", "default": True},
+                "outdated_cache_ttl": {"type": "int", "default": 0},
+                "cached": {"type": "dict"},
+                "max_age": {"type": "int", "default": 600},
+                "timeout": {"type": "int", "default": 0},
+            },
+            supports_check_mode=True,
+        )
+        self.stdout = ""
+        self.stderr = ""
+        self.timed_out = []
+        self.atom_home = (
+            self.module.params["atom_home"]
+            or os.environ.get("ATOM_HOME")
+            or os.path.expanduser("~/.atom")
+        )
+
+    def read_state(self, filename):
+        return read_state(self.atom_home, filename)
+
+    def write_state(self, filename, data):
+        write_state(self.atom_home, filename, data)
+
+    def run_command(self, command):
+        """
+        run apm like the apm module, the process group is terminated when
+        timeout is exceeded
+        """
+        timeout = self.module.params["timeout"]
+        rc, stdout, stderr, timed_out = asyncio.run(
+            execute(
+                command,
+                dict(os.environ, ATOM_HOME=self.atom_home),
+                timeout=timeout if timeout > 0 else None,
+            )
+        )
+        if timed_out:
+            self.timed_out.append(command)
+
+        return (
+            rc,
+            to_native(stdout, errors="surrogate_or_replace"),
+            to_native(stderr, errors="surrogate_or_replace"),
+        )
+
+    def get_packages_mtime(self):
+        try:
+            return os.stat(os.path.join(self.atom_home, "packages")).st_mtime_ns
+        except OSError:
+            return None
+
+    def get_fingerprint(self, installed):
+        return get_fingerprint(
+            dict((name, package["version"]) for name, package in installed.items())
+        )
+
+    def get_disabled_packages(self):
+        """
+        read core.disabledPackages of $ATOM_HOME/config.cson
+        """
+        return set(get_disabled_packages(read_config(self.atom_home))[0])
+
+    def has_native_modules(self, path):
+        return has_native_modules(path)
+
+    def get_installed_packages(self):
+        """
+        read installed packages from $ATOM_HOME/packages, returns None when
+        the layout of the directory is unexpected
+        """
+        packages = scan_packages(self.atom_home)
+        if packages is None:
+            return None
+
+        disabled = self.get_disabled_packages()
+        natives = self.read_state("native.json") or {}
+        installed, updated_natives = ({}, {})
+
+        for name, (version, path, stat) in packages.items():
+            # walking a package is expensive, so whether it has native
+            # modules is cached until it is reinstalled
+            key = "{0}:{1}:{2}".format(version, stat.st_ino, stat.st_mtime_ns)
+            if natives.get(name, {}).get("key") == key:
+                native = natives[name].get("native")
+            else:
+                native = self.has_native_modules(path)
+            updated_natives[name] = {"key": key, "native": native}
+
+            installed[name] = {
+                "version": version,
+                "path": path,
+                "native": native,
+                "disabled": name in disabled,
+            }
+
+        if updated_natives != natives:
+            self.write_state("native.json", updated_natives)
+
+        return installed
+
+    def list_installed_packages(self):
+        """
+        read installed packages by `apm list`, path and native modules of
+        packages are unknown
+        """
+        installed = {}
+        disabled = self.get_disabled_packages()
+        rc, stdout, stderr = self.run_command("apm list --json --bare --color=false")
+
+        if rc == 0:
+            try:
+                for packages in json.loads(stdout).values():
+                    for package in packages:
+                        installed[package["name"]] = {
+                            "version": package.get("version"),
+                            "path": None,
+                            "native": None,
+                            "disabled": package["name"] in disabled,
+                        }
+            except (ValueError, AttributeError, KeyError, TypeError):
+                rc, stderr = (1, "unexpected output of apm list")
+
+        self.stdout, self.stderr = stdout, stderr
+        return (rc, installed)
+
+    def get_outdated_packages(self, installed):
+        """
+        returns name -> latest version, the result is shared with the apm
+        module through $ATOM_HOME/.ansible-apm/outdated.json
+        """
+        ttl = self.module.params["outdated_cache_ttl"]
+        fingerprint = self.get_fingerprint(installed)
+
+        if ttl > 0:
+            cache = self.read_state("outdated.json")
+            if (
+                cache
+                and cache.get("fingerprint") == fingerprint
+                and 0 <= time.time() - cache.get("time", 0) < ttl
+            ):
+                return (0, cache["packages"])
+
+        outdated = {}
+        rc, stdout, stderr = self.run_command("apm upgrade --list --json --color=false")
+
+        if rc == 0:
+            outdated = parse_outdated_packages(stdout)
+
+        if rc == 0 and ttl > 0:
+            self.write_state(
+                "outdated.json",
+                {"fingerprint": fingerprint, "time": time.time(), "packages": outdated},
+            )
+
+        self.stdout, self.stderr = stdout, stderr
+        return (rc, outdated)
+
+    def is_cache_valid(self, cached, mtime):
+        if not cached or mtime is None:
+            return False
+        if cached.get("atom_home") != self.atom_home or cached.get("mtime") != mtime:
+            return False
+        if self.module.params["outdated"] and cached.get("outdated") is None:
+            return False
+
+        return 0 <= time.time() - cached.get("time", 0) < self.module.params["max_age"]
+
+    def fail(self, rc):
+        msg = "error"
+        if self.timed_out:
+            msg = "command timed out: {0}".format(", ".join(self.timed_out))
+        self.module.fail_json(
+            msg=msg,
+            rc=rc,
+            stdout=self.stdout,
+            stderr=self.stderr,
+            timed_out=self.timed_out,
+        )
+
+    def main(self):
+        mtime = self.get_packages_mtime()
+        cached = self.module.params["cached"]
+
+        # facts from the fact cache are reused while packages are unchanged
+        if self.is_cache_valid(cached, mtime):
+            self.module.exit_json(
+                changed=False, ansible_facts={"atom_packages": cached}
+            )
+
+        installed = self.get_installed_packages()
+        if installed is None:
+            rc, installed = self.list_installed_packages()
+            if rc != 0:
+                self.fail(rc)
+
+        outdated = None
+        if self.module.params["outdated"]:
+            rc, outdated = self.get_outdated_packages(installed)
+            if rc != 0:
+                self.fail(rc)
+
+        facts = {
+            "atom_home": self.atom_home,
+            "mtime": mtime,
+            "fingerprint": self.get_fingerprint(installed),
+            "time": time.time(),
+            "installed": installed,
+            "outdated": outdated,
+        }
+        self.module.exit_json(changed=False, ansible_facts={"atom_packages": facts})
+
+
+if __name__ == "__main__":
+    apm_facts = ApmFactsModule()
+    apm_facts.main()
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+
+import asyncio
+import hashlib
+import json
+import os
+import re
+import shlex
+import signal
+import tempfile
+
+from ansible.module_utils._text import to_bytes
+
+STATE_DIRECTORY = ".ansible-apm"
+READ_SIZE = 64 * 1024
+TIMEOUT_RC = 124
+TERMINATE_GRACE_PERIOD = 5
+NATIVE_SUFFIXES = (".node",)
+NATIVE_FILES = ("binding.gyp",)
+SCOPE_PATTERN = re.compile(r"^()[\"']\*[\"']:[ \t]*\n", re.M)
+CORE_PATTERN = re.compile(r"^([ \t]+)core:[ \t]*\n", re.M)
+DISABLED_PACKAGES_PATTERN = re.compile(
+    r"^([ \t]*)disabledPackages:[ \t]*\[(.*?)\][ \t]*$", re.M | re.S
+)
+
+
+def read_state(atom_home, filename):
+    """
+    read a json state file in $ATOM_HOME/.ansible-apm, returns None when it
+    doesn't exist or is broken
+    """
+    path = os.path.join(atom_home, STATE_DIRECTORY, filename)
+
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_state(atom_home, filename, data):
+    """
+    replace a json state file in $ATOM_HOME/.ansible-apm atomically
+    """
+    directory = os.path.join(atom_home, STATE_DIRECTORY)
+
+    try:
+        os.makedirs(directory, exist_ok=True)
+        fd, path = tempfile.mkstemp(dir=directory, prefix="." + filename)
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+        os.replace(path, os.path.join(directory, filename))
+    except OSError:
+        # the state files are only caches, so failing to write them
+        # must not fail the module
+        pass
+
+
+def scan_packages(atom_home):
+    """
+    read name -> (version, path, stat) of packages in $ATOM_HOME/packages
+    from their package.json, returns None when the layout of the directory
+    is unexpected
+    """
+    packages = {}
+
+    try:
+        with os.scandir(os.path.join(atom_home, "packages")) as entries:
+            for entry in entries:
+                if entry.name.startswith(".") or not entry.is_dir():
+                    continue
+                with open(os.path.join(entry.path, "package.json")) as f:
+                    manifest = json.load(f)
+                name, version = (manifest.get("name"), manifest.get("version"))
+                if not name or not version:
+                    return None
+                packages[name] = (version, entry.path, entry.stat())
+    except (OSError, ValueError, AttributeError):
+        return None
+
+    return packages
+
+
+async def terminate(process):
+    for signum in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(process.pid, signum)
+        except OSError:
+            pass
+        try:
+            await asyncio.wait_for(process.wait(), TERMINATE_GRACE_PERIOD)
+            return
+        except asyncio.TimeoutError:
+            continue
+
+
+async def execute(command, env, cwd=None, timeout=None):
+    """
+    run a command in its own process group, output is read incrementally
+    and the whole process group is terminated when timeout is exceeded,
+    returns rc, stdout and stderr in bytes and whether it timed out
+    """
+    stdout, stderr = (bytearray(), bytearray())
+
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *shlex.split(command),
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            env=env,
+            cwd=cwd,
+            start_new_session=True,
+        )
+    except OSError as e:
+        return (127, b"", to_bytes(str(e)), False)
+
+    async def read(stream, buffer):
+        while True:
+            chunk = await stream.read(READ_SIZE)
+            if not chunk:
+                break
+            buffer.extend(chunk)
+
+    try:
+        await asyncio.wait_for(
+            asyncio.gather(
+                read(process.stdout, stdout),
+                read(process.stderr, stderr),
+                process.wait(),
+            ),
+            timeout,
+        )
+        return (process.returncode, bytes(stdout), bytes(stderr), False)
+    except asyncio.TimeoutError:
+        await terminate(process)
+        stderr.extend(b"\ntimed out after %.1f seconds" % (timeout,))
+        return (TIMEOUT_RC, bytes(stdout), bytes(stderr), True)
+
+
+def get_fingerprint(versions):
+    """
+    returns a digest of name -> version of installed packages
+    """
+    packages = sorted("{0}@{1}".format(*item) for item in versions.items())
+    return hashlib.sha256("\n".join(packages).encode("utf-8")).hexdigest()
+
+
+def has_native_modules(path):
+    for directory, _, filenames in os.walk(path):
+        for filename in filenames:
+            if filename.endswith(NATIVE_SUFFIXES) or filename in NATIVE_FILES:
+                return True
+    return False
+
+
+def parse_outdated_packages(stdout):
+    """
+    parse output of `apm upgrade --list --json` into name -> latest
+    version, falls back to text output of old apm
+    """
+    outdated = {}
+
+    try:
+        for package in json.loads(stdout):
+            latest = package.get("latestVersion") or package.get("latestSha")
+            outdated[package["name"]] = latest
+        return outdated
+    except (ValueError, AttributeError, KeyError, TypeError):
+        outdated = {}
+
+    for line in stdout.splitlines():
+        matched = re.search(r"(\S+) (\S+) -> (\S+)$", line.strip())
+        if matched:
+            outdated[matched.group(1)] = matched.group(3)
+
+    return outdated
+
+
+def read_config(atom_home):
+    try:
+        with open(os.path.join(atom_home, "config.cson")) as f:
+            return f.read()
+    except OSError:
+        return ""
+
+
+def get_block(config, pattern, start=0, end=None):
+    """
+    returns the match of a key by pattern in config.cson between start and
+    end, and the end of its block, that is the next line indented as much
+    as or less than the key
+    """
+    end = len(config) if end is None else end
+    matched = pattern.search(config, start, end)
+    if not matched:
+        return (None, end)
+
+    following = re.compile(r"^[ \t]{0,%d}\S" % len(matched.group(1)), re.M).search(
+        config, matched.end(), end
+    )
+    return (matched, following.start() if following else end)
+
+
+def find_core(config):
+    """
+    returns matches of the global scope of config.cson and of core in it,
+    and the end of core, atom ignores core of other scopes
+    """
+    scope, end = get_block(config, SCOPE_PATTERN)
+    if not scope:
+        return (None, None, end)
+
+    core, end = get_block(config, CORE_PATTERN, scope.end(), end)
+    return (scope, core, end)
+
+
+def get_disabled_packages(config):
+    """
+    returns core.disabledPackages of the global scope of config.cson and the
+    match of it
+    """
+    _, core, end = find_core(config)
+    matched = core and DISABLED_PACKAGES_PATTERN.search(config, core.end(), end)
+    if not matched:
+        return ([], None)
+
+    return (re.findall(r"[\"']([^\"'\n]+)[\"']", matched.group(2)), matched)
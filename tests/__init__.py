@@ -0,0 +1,10 @@
+import os
+
+import ansible.module_utils
+
+# modules of the role import module_utils of the role like ansible does
+ansible.module_utils.__path__.append(
+    os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "module_utils"
+    )
+)
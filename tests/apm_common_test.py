@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+import asyncio
+import os
+import tempfile
+import unittest
+from ansible.module_utils.apm_common import (
+    TIMEOUT_RC,
+    execute,
+    get_disabled_packages,
+    get_fingerprint,
+    read_state,
+    scan_packages,
+    write_state,
+)
+from tests.apm_test import write_package
+
+
+class TestApmCommon(unittest.TestCase):
+    def setUp(self):
+        self.atom_home = tempfile.TemporaryDirectory()
+        self.addCleanup(self.atom_home.cleanup)
+
+    def test_read_state(self):
+        self.assertIsNone(read_state(self.atom_home.name, "hoge.json"))
+
+        write_state(self.atom_home.name, "hoge.json", {"hoge": 1})
+        self.assertDictEqual({"hoge": 1}, read_state(self.atom_home.name, "hoge.json"))
+        self.assertListEqual(
+            ["hoge.json"],
+            os.listdir(os.path.join(self.atom_home.name, ".ansible-apm")),
+        )
+
+    def test_scan_packages(self):
+        self.assertIsNone(scan_packages(self.atom_home.name))
+
+        hoge = write_package(self.atom_home.name, "hoge", "1.0.0")
+        os.makedirs(os.path.join(self.atom_home.name, "packages", ".trash"))
+        packages = scan_packages(self.atom_home.name)
+        self.assertListEqual(["hoge"], list(packages))
+        self.assertEqual(("1.0.0", hoge), packages["hoge"][:2])
+
+        os.makedirs(os.path.join(self.atom_home.name, "packages", "fuga"))
+        self.assertIsNone(scan_packages(self.atom_home.name))
+
+    def test_execute(self):
+        rc, stdout, stderr, timed_out = asyncio.run(
+            execute("sh -c 'echo hoge; echo fuga >&2'", dict(os.environ))
+        )
+        self.assertTupleEqual(
+            (0, b"hoge\n", b"fuga\n", False), (rc, stdout, stderr, timed_out)
+        )
+
+        rc, stdout, stderr, timed_out = asyncio.run(
+            execute("sleep 10", dict(os.environ), timeout=0.1)
+        )
+        self.assertEqual(TIMEOUT_RC, rc)
+        self.assertTrue(timed_out)
+        self.assertIn(b"timed out", stderr)
+
+    def test_get_fingerprint(self):
+        self.assertEqual(
+            get_fingerprint({"hoge": "1.0.0", "fuga": "2.0.0"}),
+            get_fingerprint({"fuga": "2.0.0", "hoge": "1.0.0"}),
+        )
+        self.assertNotEqual(
+            get_fingerprint({"hoge": "1.0.0"}), get_fingerprint({"hoge": "1.0.1"})
+        )
+
+    def test_get_disabled_packages(self):
+        config = (
+            '"*":\n'
+            "  core:\n"
+            "    disabledPackages: [\n"
+            '      "hoge"\n'
+            "      'fuga'\n"
+            "    ]\n"
+        )
+
+        disabled, matched = get_disabled_packages(config)
+        self.assertListEqual(["hoge", "fuga"], disabled)
+        self.assertEqual("    ", matched.group(1))
+        self.assertTupleEqual(([], None), get_disabled_packages(""))
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+import json
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+from test.support import captured_stdout
+from library.apm_facts import ApmFactsModule
+from tests.apm_test import set_module_args, write_package
+
+
+class TestApmFactsModule(unittest.TestCase):
+    def setUp(self):
+        self.atom_home = tempfile.TemporaryDirectory()
+        patcher = patch.dict(os.environ, {"ATOM_HOME": self.atom_home.name})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.atom_home.cleanup)
+
+    def run_module(self, args):
+        with captured_stdout() as stdout:
+            try:
+                set_module_args(args)
+                ApmFactsModule().main()
+            except SystemExit:
+                return json.loads(stdout.getvalue())
+
+    def test_get_installed_packages(self):
+        hoge = write_package(self.atom_home.name, "hoge", "1.0.0")
+        fuga = write_package(self.atom_home.name, "fuga", "0.1.0")
+        os.makedirs(os.path.join(fuga, "build", "Release"))
+        open(os.path.join(fuga, "build", "Release", "fuga.node"), "w").close()
+        with open(os.path.join(self.atom_home.name, "config.cson"), "w") as f:
+            f.write('"*":\n  core:\n    disabledPackages: [\n      "hoge"\n    ]\n')
+        set_module_args({})
+        apm_facts = ApmFactsModule()
+
+        expected = {
+            "hoge": {
+                "version": "1.0.0",
+                "path": hoge,
+                "native": False,
+                "disabled": True,
+            },
+            "fuga": {
+                "version": "0.1.0",
+                "path": fuga,
+                "native": True,
+                "disabled": False,
+            },
+        }
+        self.assertDictEqual(expected, apm_facts.get_installed_packages())
+
+        # whether packages have native modules is cached
+        with patch.object(ApmFactsModule, "has_native_modules") as mocked:
+            self.assertDictEqual(expected, apm_facts.get_installed_packages())
+            mocked.assert_not_called()
+
+    def test_get_installed_packages_when_layout_unexpected(self):
+        os.makedirs(os.path.join(self.atom_home.name, "packages", "hoge"))
+        set_module_args({})
+        apm_facts = ApmFactsModule()
+
+        self.assertIsNone(apm_facts.get_installed_packages())
+
+    def test_main(self):
+        with patch.object(ApmFactsModule, "run_command") as mocked_run_command:
+            stdout = [{"name": "hoge", "version": "1.0.0", "latestVersion": "1.1.0"}]
+            mocked_run_command.return_value = (0, json.dumps(stdout), "")
+            write_package(self.atom_home.name, "hoge", "1.0.0")
+
+            facts = self.run_module({})["ansible_facts"]["atom_packages"]
+            self.assertEqual(self.atom_home.name, facts["atom_home"])
+            self.assertEqual("1.0.0", facts["installed"]["hoge"]["version"])
+            self.assertDictEqual({"hoge": "1.1.0"}, facts["outdated"])
+            mocked_run_command.assert_called_once_with(
+                "apm upgrade --list --json --color=false"
+            )
+
+    def test_main_when_timed_out(self):
+        write_package(self.atom_home.name, "hoge", "1.0.0")
+        with patch("library.apm_facts.execute") as mocked_execute:
+            mocked_execute.return_value = (124, b"", b"timed out", True)
+
+            result = self.run_module({"timeout": 1})
+            self.assertTrue(result["failed"])
+            self.assertEqual(
+                "command timed out: apm upgrade --list --json --color=false",
+                result["msg"],
+            )
+            self.assertEqual(1, mocked_execute.call_args[1]["timeout"])
+
+    def test_main_when_layout_unexpected(self):
+        with patch.object(ApmFactsModule, "run_command") as mocked_run_command:
+            stdout = {"core": [], "user": [{"name": "hoge", "version": "1.0.0"}]}
+            mocked_run_command.return_value = (0, json.dumps(stdout), "")
+
+            facts = self.run_module({"outdated": False})["ansible_facts"]
+            self.assertEqual(
+                "1.0.0", facts["atom_packages"]["installed"]["hoge"]["version"]
+            )
+            self.assertIsNone(facts["atom_packages"]["outdated"])
+
+    def test_main_when_cached(self):
+        with patch.object(ApmFactsModule, "run_command") as mocked_run_command:
+            mocked_run_command.return_value = (0, "[]", "")
+            write_package(self.atom_home.name, "hoge", "1.0.0")
+            cached = self.run_module({})["ansible_facts"]["atom_packages"]
+
+            self.assertDictEqual(
+                cached,
+                self.run_module({"cached": cached})["ansible_facts"]["atom_packages"],
+            )
+            self.assertEqual(1, mocked_run_command.call_count)
+
+            # packages are changed
+            write_package(self.atom_home.name, "fuga", "1.0.0")
+            facts = self.run_module({"cached": cached})["ansible_facts"][
+                "atom_packages"
+            ]
+            self.assertIn("fuga", facts["installed"])
+            self.assertEqual(2, mocked_run_command.call_count)
+
+            # cached facts are too old
+            cached = dict(facts, time=time.time() - 3600)
+            self.run_module({"cached": cached})
+            self.assertEqual(3, mocked_run_command.call_count)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+import unittest
+from unittest.mock import MagicMock
+from callback_plugins.apm_metrics import CallbackModule
+
+
+def create_result(task, metrics):
+    result = MagicMock()
+    result._task.get_name.return_value = task
+    result._result = {"changed": False, "metrics": metrics}
+    return result
+
+
+class TestApmMetricsCallback(unittest.TestCase):
+    def test_summary(self):
+        callback = CallbackModule()
+        callback._display = MagicMock()
+        metrics = {
+            "total": 1.5,
+            "phases": {"installed": 0.25, "apply": 1.0},
+            "commands": [
+                {"command": "apm install hoge", "duration": 1.0},
+                {"command": "apm uninstall fuga", "duration": 0.25},
+            ],
+            "output_bytes": 100,
+            "cache": {"installed": {"hit": 1, "miss": 0}},
+        }
+
+        callback.v2_playbook_on_task_start(MagicMock(), False)
+        callback.v2_runner_on_ok(create_result("Install packages", metrics))
+        callback.v2_runner_on_failed(create_result("Install packages", metrics))
+        callback.v2_runner_on_ok(create_result("Other task", None))
+
+        summary = callback.summary["Install packages"]
+        self.assertListEqual(["Install packages"], list(callback.summary))
+        self.assertEqual(2, summary["hosts"])
+        self.assertEqual(3.0, summary["total"])
+        self.assertDictEqual({"installed": 0.5, "apply": 2.0}, summary["phases"])
+        self.assertEqual(4, summary["subprocesses"])
+        self.assertEqual(200, summary["output_bytes"])
+        self.assertDictEqual({"installed": {"hit": 2, "miss": 0}}, summary["cache"])
+        self.assertTupleEqual(("apm install hoge", 1.0), summary["slowest"])
+
+        callback.v2_playbook_on_stats(MagicMock())
+        output = callback._display.display.call_args[0][0]
+        self.assertIn("Install packages (2 hosts)", output)
+        self.assertIn("phase apply: 2.000s", output)
+        self.assertIn("cache installed: 2 hit, 0 miss", output)
+
+    def test_summary_when_no_apm_task(self):
+        callback = CallbackModule()
+        callback._display = MagicMock()
+
+        callback.v2_playbook_on_stats(MagicMock())
+        callback._display.banner.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,13 +1,24 @@
 #!/usr/bin/env python
 
+import base64
+import hashlib
+import io
 import json
+import os
+import shutil
+import struct
+import subprocess
+import tarfile
+import tempfile
+import time
 import unittest
 from unittest.mock import patch
+from urllib.parse import urlsplit
 from test.support import captured_stdout
 from ansible.module_utils import basic
 from ansible.module_utils._text import to_bytes
-from ansible.module_utils.basic import AnsibleModule
-from library.apm import ApmModule
+from library.apm import ApmModule, run_module
+from tests.registry import Registry
 
 
 def set_module_args(args):
@@ -18,9 +29,95 @@ def set_module_args(args):
     basic._ANSIBLE_ARGS = to_bytes(value)
 
 
+def mock_execute(side_effect):
+    """
+    returns a replacement of ApmModule.execute that records its calls
+    and the list of calls
+    """
+    calls = []
+
+    async def execute(self, command, environ_update=None, cwd=None):
+        calls.append((command, environ_update))
+        rc, stdout, stderr = side_effect(command, environ_update)
+        return (rc, stdout, stderr, 0.0)
+
+    return (execute, calls)
+
+
+def write_package(atom_home, name, version, directory=None):
+    """
+    create a package directory in atom_home that has only package.json
+    """
+    path = os.path.join(atom_home, "packages", directory or name)
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, "package.json"), "w") as f:
+        json.dump({"name": name, "version": version}, f)
+    return path
+
+
+def write_asar(path, files):
+    """
+    create an asar archive that has files at the top level
+    """
+    header, contents = ({"files": {}}, b"")
+    for name, content in files.items():
+        header["files"][name] = {"offset": str(len(contents)), "size": len(content)}
+        contents += content
+    data = json.dumps(header).encode("utf-8")
+    padding = b"\0" * (-len(data) % 4)
+    payload_size = 4 + len(data) + len(padding)
+    with open(path, "wb") as f:
+        f.write(struct.pack("<4I", 4, 4 + payload_size, payload_size, len(data)))
+        f.write(data + padding + contents)
+
+
+def write_cacache(atom_home, key, content, time):
+    """
+    add content by key to cacache of npm in atom_home, returns paths of the
+    index bucket and the content
+    """
+    root = os.path.join(atom_home, ".apm", "_cacache")
+    digest = hashlib.sha512(content).digest()
+    data = json.dumps(
+        {
+            "key": key,
+            "integrity": "sha512-" + base64.b64encode(digest).decode(),
+            "time": time * 1000,
+            "size": len(content),
+        }
+    )
+    bucket, content_hex = (hashlib.sha256(key.encode()).hexdigest(), digest.hex())
+    paths = (
+        os.path.join(root, "index-v5", bucket[:2], bucket[2:4], bucket[4:]),
+        os.path.join(
+            root,
+            "content-v2",
+            "sha512",
+            content_hex[:2],
+            content_hex[2:4],
+            content_hex[4:],
+        ),
+    )
+    for path in paths:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(paths[0], "a") as f:
+        f.write("\n{0}\t{1}".format(hashlib.sha1(data.encode()).hexdigest(), data))
+    with open(paths[1], "wb") as f:
+        f.write(content)
+    os.utime(paths[0], (time, time))
+    return paths
+
+
 class TestApmModule(unittest.TestCase):
+    def setUp(self):
+        self.atom_home = tempfile.TemporaryDirectory()
+        patcher = patch.dict(os.environ, {"ATOM_HOME": self.atom_home.name})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.atom_home.cleanup)
+
     def test_is_package_installed(self):
-        with patch.object(AnsibleModule, "run_command") as mocked_run_command:
+        with patch.object(ApmModule, "run_command") as mocked_run_command:
             cases = [
                 ("hoge", True),
                 ("fuga", True),
@@ -42,8 +139,26 @@ class TestApmModule(unittest.TestCase):
                 actual = apm.is_package_installed(name)
                 self.assertTupleEqual(expected, actual)
 
+    def test_is_package_installed_when_name_is_prefix_of_other_package(self):
+        with patch.object(ApmModule, "run_command") as mocked_run_command:
+            mocked_run_command.return_value = (0, "linter-ui-default@1.0.0", "")
+            set_module_args({"name": "linter"})
+            apm = ApmModule()
+
+            self.assertTupleEqual((0, False), apm.is_package_installed("linter"))
+
+    def test_is_package_installed_when_packages_directory_exists(self):
+        with patch.object(ApmModule, "run_command") as mocked_run_command:
+            write_package(self.atom_home.name, "hoge", "0.0.0")
+            set_module_args({"name": "hoge"})
+            apm = ApmModule()
+
+            self.assertTupleEqual((0, True), apm.is_package_installed("hoge"))
+            self.assertTupleEqual((0, False), apm.is_package_installed("fuga"))
+            mocked_run_command.assert_not_called()
+
     def test_is_package_installed_when_fail(self):
-        with patch.object(AnsibleModule, "run_command") as mocked_run_command:
+        with patch.object(ApmModule, "run_command") as mocked_run_command:
             name = "hoge"
             mocked_run_command.return_value = (1, "", "error detail")
             set_module_args({"name": name})
@@ -67,7 +182,7 @@ class TestApmModule(unittest.TestCase):
             self.assertTupleEqual(expected, actual)
 
     def test_package_install_when_not_installed(self):
-        with patch.object(AnsibleModule, "run_command") as mocked_run_command:
+        with patch.object(ApmModule, "run_command") as mocked_run_command:
             with patch.object(
                 ApmModule, "is_package_installed"
             ) as mocked_is_package_installed:
@@ -120,7 +235,7 @@ class TestApmModule(unittest.TestCase):
         with patch.object(
             ApmModule, "is_not_package_latest"
         ) as mocked_is_not_package_latest:
-            with patch.object(AnsibleModule, "run_command") as mocked_run_command:
+            with patch.object(ApmModule, "run_command") as mocked_run_command:
                 name = "hoge"
                 stdout = (
                     "Package Updates Available (1)\n"
@@ -138,7 +253,7 @@ class TestApmModule(unittest.TestCase):
                 self.assertTupleEqual(expected, actual)
 
     def test_package_uninstall_when_installed(self):
-        with patch.object(AnsibleModule, "run_command") as mocked_run_command:
+        with patch.object(ApmModule, "run_command") as mocked_run_command:
             with patch.object(
                 ApmModule, "is_package_installed"
             ) as mocked_is_package_installed:
@@ -153,6 +268,471 @@ class TestApmModule(unittest.TestCase):
                 actual = apm.package_uninstall(name)
                 self.assertTupleEqual(expected, actual)
 
+    def test_package_uninstall_when_uninstall_mode_trash(self):
+        with patch.object(ApmModule, "delete_in_background") as mocked_delete:
+            write_package(self.atom_home.name, "hoge", "0.0.0")
+            set_module_args({"name": "hoge", "uninstall_mode": "trash"})
+            apm = ApmModule()
+
+            self.assertTupleEqual((0, True), apm.package_uninstall("hoge"))
+            self.assertDictEqual({}, apm.get_package_index())
+            (trashed,), kwargs = mocked_delete.call_args
+            self.assertEqual(1, len(trashed))
+            self.assertTrue(
+                os.path.isfile(os.path.join(trashed[0], "hoge", "package.json"))
+            )
+
+    def test_packages_apply_when_uninstall_mode_trash(self):
+        with patch.object(ApmModule, "run_command") as mocked_run_command:
+            with patch.object(ApmModule, "delete_in_background") as mocked_delete:
+                write_package(self.atom_home.name, "hoge", "0.0.0")
+                write_package(self.atom_home.name, "fuga", "0.0.0")
+                packages = [
+                    {"name": "hoge", "state": "absent"},
+                    {"name": "fuga", "state": "absent"},
+                ]
+                set_module_args({"packages": packages, "uninstall_mode": "trash"})
+                apm = ApmModule()
+
+                actual = apm.packages_apply(apm.module.params["packages"])
+                self.assertTupleEqual((0, True), actual)
+                self.assertDictEqual({}, apm.get_package_index())
+                self.assertEqual(2, len(mocked_delete.call_args[0][0]))
+                mocked_run_command.assert_not_called()
+
+    def test_get_electron_version(self):
+        path = os.path.join(self.atom_home.name, "app.asar")
+        manifest = json.dumps({"name": "atom", "electronVersion": "9.4.4"})
+        write_asar(path, {"index.js": b"1", "package.json": manifest.encode("utf-8")})
+        set_module_args({"name": "hoge"})
+
+        with patch("library.apm.ATOM_ARCHIVES", ("/nonexistent/app.asar", path)):
+            self.assertEqual("9.4.4", ApmModule().get_electron_version())
+
+        # electron_version overrides the installed atom
+        set_module_args({"name": "hoge", "electron_version": "6.1.12"})
+        self.assertEqual("6.1.12", ApmModule().get_electron_version())
+
+    def test_packages_apply_when_package_store_set(self):
+        store = os.path.join(self.atom_home.name, "store")
+        profiles = [os.path.join(self.atom_home.name, p) for p in ("a", "b")]
+        packages = [{"name": "hoge"}]
+
+        def create_module(profile, packages):
+            set_module_args(
+                {"atom_home": profile, "packages": packages, "package_store": store}
+            )
+            return ApmModule()
+
+        def install(command, *args, **kwargs):
+            write_package(profiles[0], "hoge", "1.0.0")
+            return (0, "", "")
+
+        with patch.object(ApmModule, "run_command") as mocked_run_command:
+            with patch.object(ApmModule, "get_registry_metadata") as mocked_metadata:
+                mocked_run_command.side_effect = install
+                mocked_metadata.return_value = (
+                    0,
+                    "",
+                    {"releases": {"latest": "1.0.0"}},
+                )
+                for profile in profiles:
+                    os.makedirs(os.path.join(profile, "packages"))
+
+                # the first profile installs hoge by apm and adds it to the store
+                apm = create_module(profiles[0], packages)
+                self.assertTupleEqual((0, True), apm.packages_apply(packages))
+                self.assertEqual(1, mocked_run_command.call_count)
+
+                # the second profile links hoge from the store
+                apm = create_module(profiles[1], packages)
+                self.assertTupleEqual((0, True), apm.packages_apply(packages))
+                self.assertEqual(1, mocked_run_command.call_count)
+                self.assertEqual({"hit": 1, "miss": 0}, apm.metrics["cache"]["store"])
+                paths = [
+                    os.path.join(profile, "packages", "hoge", "package.json")
+                    for profile in profiles
+                ]
+                self.assertTrue(os.path.samefile(*paths))
+
+            # uninstalling from a profile keeps the entry for the other
+            absent = [{"name": "hoge", "state": "absent"}]
+            mocked_run_command.side_effect = None
+            mocked_run_command.return_value = (0, "", "")
+            apm = create_module(profiles[0], absent)
+            shutil.rmtree(os.path.join(profiles[0], "packages", "hoge"))
+            apm.update_store({"install": [], "upgrade": [], "uninstall": ["hoge"]})
+            (entry,) = [e for e in os.listdir(store) if not e.startswith(".")]
+            self.assertTrue(os.path.isfile(paths[1]))
+
+            apm = create_module(profiles[1], absent)
+            apm.update_store({"install": [], "upgrade": [], "uninstall": ["hoge"]})
+            self.assertFalse(os.path.exists(os.path.join(store, entry)))
+
+    def test_main_when_name_and_package_store_set(self):
+        store = os.path.join(self.atom_home.name, "store")
+        profiles = [os.path.join(self.atom_home.name, p) for p in ("a", "b")]
+        current = []
+
+        def run_module(profile, state):
+            current[:] = [profile]
+            set_module_args(
+                {
+                    "atom_home": profile,
+                    "name": "hoge",
+                    "state": state,
+                    "package_store": store,
+                }
+            )
+            with captured_stdout():
+                try:
+                    ApmModule().main()
+                except SystemExit:
+                    pass
+
+        def run_command(command, *args, **kwargs):
+            if command.startswith("apm install"):
+                write_package(current[0], "hoge", "1.0.0")
+            elif command.startswith("apm uninstall"):
+                shutil.rmtree(os.path.join(current[0], "packages", "hoge"))
+            return (0, "", "")
+
+        def get_entries():
+            return [e for e in os.listdir(store) if not e.startswith(".")]
+
+        with patch.object(ApmModule, "run_command") as mocked_run_command:
+            with patch.object(ApmModule, "get_registry_metadata") as mocked_metadata:
+                mocked_run_command.side_effect = run_command
+                mocked_metadata.return_value = (
+                    0,
+                    "",
+                    {"releases": {"latest": "1.0.0"}},
+                )
+                for profile in profiles:
+                    os.makedirs(os.path.join(profile, "packages"))
+
+                # a single package is added to and linked from the store
+                run_module(profiles[0], "present")
+                run_module(profiles[1], "present")
+                self.assertEqual(1, mocked_run_command.call_count)
+                self.assertEqual(1, len(get_entries()))
+
+                # and released from the store when it is uninstalled
+                run_module(profiles[0], "absent")
+                self.assertEqual(1, len(get_entries()))
+                run_module(profiles[1], "absent")
+                self.assertListEqual([], get_entries())
+
+    def test_rebuild_packages(self):
+        with patch.object(ApmModule, "run_parallel") as mocked_run_parallel:
+            mocked_run_parallel.return_value = [(0, "", "", 0.0)] * 2
+            for name in ("hoge", "fuga", "piyo", "hogera"):
+                path = write_package(self.atom_home.name, name, "1.0.0")
+                if name != "fuga":
+                    open(os.path.join(path, "binding.gyp"), "w").close()
+            set_module_args(
+                {"name": "hoge", "electron_version": "6.1.12", "workers": 2}
+            )
+            apm = ApmModule()
+            apm.record_abi(["hoge", "fuga", "piyo"])
+            with patch.object(ApmModule, "get_electron_version") as mocked:
+                mocked.return_value = "4.2.7"
+                apm.record_abi(["hoge"])
+
+            # hoge is built against another electron and hogera is unknown,
+            # fuga has no native modules and piyo is up to date
+            self.assertEqual(0, apm.rebuild_packages())
+            commands, workers = mocked_run_parallel.call_args[0]
+            packages = os.path.join(self.atom_home.name, "packages")
+            self.assertListEqual(
+                [
+                    ("apm rebuild --color=false", os.path.join(packages, "hoge")),
+                    ("apm rebuild --color=false", os.path.join(packages, "hogera")),
+                ],
+                commands,
+            )
+            self.assertEqual(2, workers)
+            self.assertListEqual(["hoge", "hogera"], apm.rebuilt)
+
+            # rebuilt packages are recorded
+            self.assertListEqual([], apm.get_rebuild_packages())
+
+    def test_main_when_rebuild_set(self):
+        with captured_stdout() as stdout:
+            with patch.object(ApmModule, "packages_apply") as mocked_packages_apply:
+                with patch.object(ApmModule, "rebuild_packages") as mocked_rebuild:
+                    mocked_packages_apply.return_value = (0, False)
+                    mocked_rebuild.return_value = 0
+
+                    try:
+                        set_module_args({"packages": [], "rebuild": True})
+                        apm = ApmModule()
+                        apm.rebuilt = ["hoge"]
+                        apm.main()
+                    except SystemExit:
+                        actual = json.loads(stdout.getvalue())
+                        self.assertEqual(True, actual["changed"])
+                        self.assertListEqual(["hoge"], actual["rebuilt"])
+
+    def test_main_when_only_rebuild_set(self):
+        with captured_stdout() as stdout:
+            with patch.object(ApmModule, "packages_apply") as mocked_packages_apply:
+                with patch.object(ApmModule, "rebuild_packages") as mocked_rebuild:
+                    with patch.object(ApmModule, "run_command") as mocked_run_command:
+                        mocked_rebuild.return_value = 0
+
+                        try:
+                            set_module_args({"rebuild": True})
+                            apm = ApmModule()
+                            apm.rebuilt = ["hoge"]
+                            apm.main()
+                        except SystemExit:
+                            actual = json.loads(stdout.getvalue())
+                            self.assertEqual(True, actual["changed"])
+                            self.assertListEqual(["hoge"], actual["rebuilt"])
+
+                        # installed packages are not converged at all
+                        mocked_packages_apply.assert_not_called()
+                        mocked_run_command.assert_not_called()
+                        mocked_rebuild.assert_called_once_with()
+                        self.assertFalse(
+                            os.path.exists(
+                                os.path.join(
+                                    self.atom_home.name, ".ansible-apm", "stamp.json"
+                                )
+                            )
+                        )
+
+    def test_prune_caches(self):
+        entries = {
+            ".apm/hoge/1.0.0": 100,
+            ".apm/fuga/1.0.0": 0,
+            ".apm/fuga/2.0.0": 300,
+            ".node-gyp/.node-gyp/6.1.12": 200,
+        }
+        for path, atime in entries.items():
+            directory = os.path.join(self.atom_home.name, path)
+            os.makedirs(directory)
+            with open(os.path.join(directory, "package.tgz"), "wb") as f:
+                f.write(b"0" * 300 * 1024)
+            os.utime(os.path.join(directory, "package.tgz"), (atime, atime))
+            os.utime(directory, (atime, os.stat(directory).st_mtime))
+        write_package(self.atom_home.name, "hoge", "1.0.0")
+
+        with patch.object(ApmModule, "delete_in_background") as mocked_delete:
+            set_module_args(
+                {"name": "hoge", "cache_max_size": 1, "electron_version": "6.1.12"}
+            )
+            apm = ApmModule()
+
+            # hoge and headers of the electron are protected, and fuga@1.0.0
+            # is the least recently used
+            apm.prune_caches(["hoge"])
+            self.assertEqual(300 * 1024, apm.pruned["reclaimed"])
+            self.assertEqual(1, apm.pruned["evicted"])
+            self.assertFalse(
+                os.path.exists(os.path.join(self.atom_home.name, ".apm/fuga/1.0.0"))
+            )
+            self.assertEqual(1, len(mocked_delete.call_args[0][0]))
+
+            # caches are not walked when no apm command ran and they fit
+            with patch.object(ApmModule, "list_cache_entries") as mocked_list:
+                apm.prune_caches(["hoge"])
+                mocked_list.assert_not_called()
+                self.assertEqual(900 * 1024, apm.pruned["size"])
+
+            # sizes of unchanged entries are not walked again
+            apm.metrics["commands"].append({"command": "apm install hoge"})
+            with patch.object(ApmModule, "get_tree_size") as mocked_get_tree_size:
+                apm.prune_caches(["hoge"])
+                mocked_get_tree_size.assert_not_called()
+                self.assertEqual(0, apm.pruned["reclaimed"])
+                self.assertEqual(900 * 1024, apm.pruned["size"])
+
+    def test_prune_caches_when_cacache(self):
+        registry = "https://registry.npmjs.org/"
+        underscore = write_cacache(
+            self.atom_home.name,
+            "make-fetch-happen:request-cache:"
+            + registry
+            + "underscore/-/underscore-1.0.0.tgz",
+            b"1" * 400 * 1024,
+            100,
+        )
+        fuga = write_cacache(
+            self.atom_home.name,
+            "make-fetch-happen:request-cache:"
+            + registry
+            + "@scope/fuga/-/fuga-1.0.0.tgz",
+            b"2" * 400 * 1024,
+            200,
+        )
+        piyo = write_cacache(
+            self.atom_home.name,
+            "make-fetch-happen:request-cache:" + registry + "piyo",
+            b"3" * 400 * 1024,
+            300,
+        )
+        path = write_package(self.atom_home.name, "hoge", "1.0.0")
+        os.makedirs(os.path.join(path, "node_modules", "underscore"))
+        with open(
+            os.path.join(path, "node_modules", "underscore", "package.json"), "w"
+        ) as f:
+            json.dump({"name": "underscore", "version": "1.0.0"}, f)
+
+        with patch.object(ApmModule, "delete_in_background"):
+            set_module_args({"name": "hoge", "cache_max_size": 1})
+            apm = ApmModule()
+
+            # the tarball of underscore is protected as a dependency of hoge,
+            # and the content of the evicted key is collected
+            apm.prune_caches(["hoge"])
+            self.assertEqual(400 * 1024, apm.pruned["reclaimed"])
+            self.assertEqual(1, apm.pruned["evicted"])
+            for path in fuga:
+                self.assertFalse(os.path.exists(path))
+            for path in underscore + piyo:
+                self.assertTrue(os.path.exists(path))
+
+    def test_list_cacache_entries(self):
+        write_cacache(self.atom_home.name, "hoge", b"1", 100)
+        set_module_args({"name": "hoge"})
+        apm = ApmModule()
+
+        entries, directories = apm.list_cacache_entries({}, {})
+        self.assertEqual(1, len(entries))
+        self.assertEqual(3, len(directories))
+
+        # only directories that changed are listed, and only new buckets
+        # are read
+        fuga, _ = write_cacache(self.atom_home.name, "fuga", b"2", 200)
+        with patch.object(
+            ApmModule, "read_cacache_bucket", wraps=apm.read_cacache_bucket
+        ) as mocked_read:
+            with patch("os.scandir", wraps=os.scandir) as mocked_scandir:
+                entries, directories = apm.list_cacache_entries(entries, directories)
+                mocked_read.assert_called_once_with(fuga)
+                self.assertEqual(3, mocked_scandir.call_count)
+        self.assertEqual(2, len(entries))
+        self.assertEqual(5, len(directories))
+
+        with patch("os.scandir") as mocked_scandir:
+            self.assertTupleEqual(
+                (entries, directories), apm.list_cacache_entries(entries, directories)
+            )
+            mocked_scandir.assert_not_called()
+
+    def test_list_cache_entries(self):
+        for path in [".apm/hoge/1.0.0", ".apm/@scope/fuga/1.0.0", ".apm/_locks/x"]:
+            os.makedirs(os.path.join(self.atom_home.name, path))
+        write_cacache(self.atom_home.name, "piyo", b"1", 100)
+        set_module_args({"name": "hoge"})
+
+        actual = ApmModule().list_cache_entries()
+        self.assertListEqual(
+            [".apm/@scope/fuga/1.0.0", ".apm/hoge/1.0.0"], sorted(actual)
+        )
+
+    def test_packages_apply_when_disabled_and_enabled(self):
+        with patch.object(ApmModule, "run_command") as mocked_run_command:
+            mocked_run_command.return_value = (0, "", "")
+            config = os.path.join(self.atom_home.name, "config.cson")
+            with open(config, "w") as f:
+                f.write('"*":\n  core:\n    disabledPackages: ["fuga"]\n')
+            write_package(self.atom_home.name, "hoge", "0.0.0")
+            write_package(self.atom_home.name, "fuga", "0.0.0")
+            packages = [
+                {"name": "hoge", "state": "disabled"},
+                {"name": "fuga", "state": "enabled"},
+                {"name": "piyo", "state": "disabled"},
+            ]
+            set_module_args({"packages": packages})
+            apm = ApmModule()
+
+            # packages that are not installed are installed and disabled
+            actual = apm.packages_apply(apm.module.params["packages"])
+            self.assertTupleEqual((0, True), actual)
+            mocked_run_command.assert_called_once_with("apm install piyo --color=false")
+            self.assertListEqual(
+                ["hoge", "piyo"], apm.get_disabled_packages(apm.read_config())[0]
+            )
+            self.assertListEqual(
+                ["disable", "enable", "install"],
+                [result["action"] for result in apm.results],
+            )
+
+            # config.cson is not written again
+            write_package(self.atom_home.name, "piyo", "0.0.0")
+            mtime = os.stat(config).st_mtime_ns
+            actual = apm.packages_apply(apm.module.params["packages"])
+            self.assertTupleEqual((0, False), actual)
+            self.assertEqual(mtime, os.stat(config).st_mtime_ns)
+
+    def test_set_disabled_packages(self):
+        set_module_args({"name": "hoge"})
+        apm = ApmModule()
+        config = '"*":\n  core:\n    themes: [\n      "one-dark-ui"\n    ]\n'
+        expected = (
+            '"*":\n  core:\n    disabledPackages: [\n      "hoge"\n    ]\n'
+            '    themes: [\n      "one-dark-ui"\n    ]\n'
+        )
+
+        self.assertEqual(expected, apm.set_disabled_packages(config, ["hoge"]))
+        self.assertEqual(
+            '"*":\n  core:\n    disabledPackages: [\n      "hoge"\n    ]\n',
+            apm.set_disabled_packages("", ["hoge"]),
+        )
+
+    def test_set_disabled_packages_when_core_in_other_scope(self):
+        set_module_args({"name": "hoge"})
+        apm = ApmModule()
+        config = (
+            '"*":\n  editor:\n    fontSize: 14\n'
+            '".source.python":\n  core:\n    disabledPackages: ["fuga"]\n'
+        )
+        expected = (
+            '"*":\n  core:\n    disabledPackages: [\n      "hoge"\n    ]\n'
+            "  editor:\n    fontSize: 14\n"
+            '".source.python":\n  core:\n    disabledPackages: ["fuga"]\n'
+        )
+
+        # core of scopes other than the global scope is ignored by atom
+        self.assertTupleEqual(([], None), apm.get_disabled_packages(config))
+        actual = apm.set_disabled_packages(config, ["hoge"])
+        self.assertEqual(expected, actual)
+        self.assertListEqual(["hoge"], apm.get_disabled_packages(actual)[0])
+
+    def test_delete_in_background(self):
+        path = write_package(self.atom_home.name, "hoge", "0.0.0")
+        set_module_args({"name": "hoge"})
+        apm = ApmModule()
+
+        apm.delete_in_background([path])
+        for _ in range(50):
+            if not os.path.exists(path):
+                break
+            time.sleep(0.1)
+        self.assertFalse(os.path.exists(path))
+
+    def test_purge_trash(self):
+        trash = os.path.join(self.atom_home.name, ".ansible-apm", "trash")
+        path = write_package(
+            self.atom_home.name, "hoge", "0.0.0", "../.ansible-apm/trash/hoge.1"
+        )
+        os.symlink(self.atom_home.name, os.path.join(path, "link"))
+        os.makedirs(os.path.join(trash, "fuga.2"))
+        set_module_args({"name": "hoge"})
+        apm = ApmModule()
+
+        # nothing is deleted without budget
+        apm.purge_trash(0)
+        self.assertListEqual(["fuga.2", "hoge.1"], sorted(os.listdir(trash)))
+
+        apm.purge_trash(10)
+        self.assertListEqual([], os.listdir(trash))
+        self.assertTrue(os.path.isdir(self.atom_home.name))
+        self.assertIn("trash", apm.metrics["phases"])
+
     def test_package_uninstall_when_not_installed(self):
         with patch.object(
             ApmModule, "is_package_installed"
@@ -278,6 +858,673 @@ class TestApmModule(unittest.TestCase):
                     self.assertEqual(apm.stderr, actual["stderr"])
                     self.assertEqual(apm.stdout, actual["stdout"])
 
+    def test_get_installed_packages(self):
+        with patch.object(ApmModule, "run_command") as mocked_run_command:
+            mocked_run_command.return_value = (
+                0,
+                ("piyo@0.0.0\n" "fuga@1.2.3\n" "@scoped/hoge@0.1.0\n"),
+                "",
+            )
+            set_module_args({"name": "hoge"})
+            apm = ApmModule()
+
+            expected = (
+                0,
+                {"piyo": "0.0.0", "fuga": "1.2.3", "@scoped/hoge": "0.1.0"},
+            )
+            actual = apm.get_installed_packages()
+            self.assertTupleEqual(expected, actual)
+
+    def test_get_package_index(self):
+        write_package(self.atom_home.name, "hoge", "0.0.0")
+        write_package(self.atom_home.name, "fuga", "1.2.3", directory="fuga-dev")
+        set_module_args({"name": "hoge"})
+        apm = ApmModule()
+
+        expected = {"hoge": "0.0.0", "fuga": "1.2.3"}
+        self.assertDictEqual(expected, apm.get_package_index())
+        self.assertDictEqual(expected, apm.read_state("installed.json")["packages"])
+
+    def test_get_package_index_when_cached(self):
+        set_module_args({"name": "hoge"})
+        apm = ApmModule()
+        packages_directory = os.path.join(self.atom_home.name, "packages")
+        os.makedirs(packages_directory)
+        mtime = os.stat(packages_directory).st_mtime_ns
+        apm.write_state("installed.json", {"mtime": mtime, "packages": {"a": "1"}})
+
+        self.assertDictEqual({"a": "1"}, apm.get_package_index())
+
+        # adding a package changes mtime of the packages directory
+        write_package(self.atom_home.name, "hoge", "0.0.0")
+        self.assertDictEqual({"hoge": "0.0.0"}, apm.get_package_index())
+
+    def test_get_package_index_when_layout_unexpected(self):
+        os.makedirs(os.path.join(self.atom_home.name, "packages", "hoge"))
+        set_module_args({"name": "hoge"})
+        apm = ApmModule()
+
+        self.assertIsNone(apm.get_package_index())
+
+    def test_get_installed_packages_when_packages_directory_exists(self):
+        with patch.object(ApmModule, "run_command") as mocked_run_command:
+            write_package(self.atom_home.name, "hoge", "0.0.0")
+            set_module_args({"name": "hoge"})
+            apm = ApmModule()
+
+            self.assertTupleEqual((0, {"hoge": "0.0.0"}), apm.get_installed_packages())
+            mocked_run_command.assert_not_called()
+
+    def test_parse_installed_packages(self):
+        set_module_args({"name": "hoge"})
+        apm = ApmModule()
+        stdout = json.dumps(
+            {
+                "core": [{"name": "tabs", "version": "0.110.0"}],
+                "dev": [],
+                "git": [{"name": "fuga", "version": "0.1.0"}],
+                "user": [{"name": "hoge", "version": "1.0.0"}],
+            }
+        )
+
+        expected = {"tabs": "0.110.0", "fuga": "0.1.0", "hoge": "1.0.0"}
+        self.assertDictEqual(expected, apm.parse_installed_packages(stdout))
+
+    def test_parse_outdated_packages(self):
+        set_module_args({"name": "hoge"})
+        apm = ApmModule()
+        stdout = json.dumps(
+            [
+                {"name": "hoge", "version": "1.0.0", "latestVersion": "1.1.0"},
+                {"name": "fuga", "version": "0.1.0", "latestSha": "abcdef"},
+            ]
+        )
+
+        expected = {"hoge": "1.1.0", "fuga": "abcdef"}
+        self.assertDictEqual(expected, apm.parse_outdated_packages(stdout))
+
+    def test_parse_outdated_packages_when_text(self):
+        set_module_args({"name": "hoge"})
+        apm = ApmModule()
+        stdout = "Package Updates Available (1)\n└── hoge 0.0.0 -> 0.0.1"
+
+        self.assertDictEqual({"hoge": "0.0.1"}, apm.parse_outdated_packages(stdout))
+        self.assertDictEqual({}, apm.parse_outdated_packages("└── (empty)"))
+
+    def test_get_outdated_packages(self):
+        with patch.object(ApmModule, "run_command") as mocked_run_command:
+            mocked_run_command.return_value = (
+                0,
+                (
+                    "Package Updates Available (2)\n"
+                    "├── hoge 0.0.0 -> 0.0.1\n"
+                    "└── fuga 1.0.0 -> 2.0.0"
+                ),
+                "",
+            )
+            set_module_args({"name": "hoge"})
+            apm = ApmModule()
+
+            expected = (0, {"hoge": "0.0.1", "fuga": "2.0.0"})
+            actual = apm.get_outdated_packages()
+            self.assertTupleEqual(expected, actual)
+
+    def test_get_installed_packages_when_facts_set(self):
+        with patch.object(ApmModule, "run_command") as mocked_run_command:
+            write_package(self.atom_home.name, "hoge", "0.0.0")
+            mtime = os.stat(os.path.join(self.atom_home.name, "packages")).st_mtime_ns
+            facts = {
+                "atom_home": self.atom_home.name,
+                "mtime": mtime,
+                "time": time.time(),
+                "installed": {"hoge": {"version": "0.0.0"}},
+                "outdated": {"hoge": "0.0.1"},
+            }
+            set_module_args({"name": "hoge", "facts": facts})
+            apm = ApmModule()
+
+            self.assertTupleEqual((0, {"hoge": "0.0.0"}), apm.get_installed_packages())
+            self.assertTupleEqual((0, {"hoge": "0.0.1"}), apm.get_outdated_packages())
+            mocked_run_command.assert_not_called()
+
+            # facts are ignored after packages are changed
+            mocked_run_command.return_value = (0, "[]", "")
+            write_package(self.atom_home.name, "fuga", "0.0.0")
+            self.assertTupleEqual((0, {}), apm.get_outdated_packages())
+            self.assertEqual({"hit": 2, "miss": 1}, apm.metrics["cache"]["facts"])
+
+    def test_get_outdated_packages_when_cached(self):
+        with patch.object(ApmModule, "run_command") as mocked_run_command:
+            mocked_run_command.return_value = (
+                0,
+                "Package Updates Available (1)\n└── hoge 0.0.0 -> 0.0.1",
+                "",
+            )
+            write_package(self.atom_home.name, "hoge", "0.0.0")
+            set_module_args({"name": "hoge", "outdated_cache_ttl": 3600})
+            apm = ApmModule()
+
+            expected = (0, {"hoge": "0.0.1"})
+            self.assertTupleEqual(expected, apm.get_outdated_packages())
+            self.assertTupleEqual(expected, apm.get_outdated_packages())
+            self.assertEqual(1, mocked_run_command.call_count)
+
+            # installed packages are changed
+            write_package(self.atom_home.name, "fuga", "0.0.0")
+            self.assertTupleEqual(expected, apm.get_outdated_packages())
+            self.assertEqual(2, mocked_run_command.call_count)
+
+    def test_get_outdated_packages_when_cache_expired(self):
+        with patch.object(ApmModule, "run_command") as mocked_run_command:
+            mocked_run_command.return_value = (0, "", "")
+            write_package(self.atom_home.name, "hoge", "0.0.0")
+            set_module_args({"name": "hoge", "outdated_cache_ttl": 3600})
+            apm = ApmModule()
+            fingerprint = apm.get_fingerprint({"hoge": "0.0.0"})
+            apm.write_state(
+                "outdated.json",
+                {"fingerprint": fingerprint, "time": 0, "packages": {"hoge": "1"}},
+            )
+
+            self.assertTupleEqual((0, {}), apm.get_outdated_packages())
+            self.assertEqual(1, mocked_run_command.call_count)
+
+    def test_get_outdated_packages_when_force_refresh(self):
+        with patch.object(ApmModule, "run_command") as mocked_run_command:
+            mocked_run_command.return_value = (0, "", "")
+            write_package(self.atom_home.name, "hoge", "0.0.0")
+            set_module_args(
+                {"name": "hoge", "outdated_cache_ttl": 3600, "force_refresh": True}
+            )
+            apm = ApmModule()
+            fingerprint = apm.get_fingerprint({"hoge": "0.0.0"})
+            apm.write_state(
+                "outdated.json",
+                {
+                    "fingerprint": fingerprint,
+                    "time": time.time(),
+                    "packages": {"hoge": "1"},
+                },
+            )
+
+            self.assertTupleEqual((0, {}), apm.get_outdated_packages())
+            self.assertEqual(1, mocked_run_command.call_count)
+
+    def test_packages_apply(self):
+        with patch.object(ApmModule, "run_command") as mocked_run_command:
+            with patch.object(
+                ApmModule, "get_installed_packages"
+            ) as mocked_get_installed_packages:
+                with patch.object(
+                    ApmModule, "get_outdated_packages"
+                ) as mocked_get_outdated_packages:
+                    mocked_run_command.return_value = (0, "", "")
+                    mocked_get_installed_packages.return_value = (
+                        0,
+                        {"fuga": "0.0.0", "piyo": "0.0.0", "foo": "0.0.0"},
+                    )
+                    mocked_get_outdated_packages.return_value = (0, {"fuga": "0.0.1"})
+                    packages = [
+                        {"name": "hoge"},
+                        {"name": "bar", "state": "present"},
+                        {"name": "fuga", "state": "latest"},
+                        {"name": "piyo", "state": "latest"},
+                        {"name": "foo", "state": "absent"},
+                        {"name": "baz", "state": "absent"},
+                    ]
+                    set_module_args({"packages": packages, "state": "latest"})
+                    apm = ApmModule()
+
+                    expected = (0, True)
+                    actual = apm.packages_apply(apm.module.params["packages"])
+                    self.assertTupleEqual(expected, actual)
+                    self.assertEqual(1, mocked_get_installed_packages.call_count)
+                    self.assertEqual(1, mocked_get_outdated_packages.call_count)
+                    self.assertListEqual(
+                        [
+                            "apm install hoge bar --color=false",
+                            "apm upgrade fuga --confirm=false --color=false",
+                            "apm uninstall foo --color=false",
+                        ],
+                        [c[0][0] for c in mocked_run_command.call_args_list],
+                    )
+                    self.assertListEqual(
+                        ["install", "install", "upgrade", None, "uninstall", None],
+                        [result["action"] for result in apm.results],
+                    )
+
+    def test_packages_apply_when_not_changed(self):
+        with patch.object(ApmModule, "run_command") as mocked_run_command:
+            with patch.object(
+                ApmModule, "get_installed_packages"
+            ) as mocked_get_installed_packages:
+                with patch.object(
+                    ApmModule, "get_outdated_packages"
+                ) as mocked_get_outdated_packages:
+                    mocked_get_installed_packages.return_value = (0, {"hoge": "0.0.0"})
+                    packages = [
+                        {"name": "hoge", "state": "present"},
+                        {"name": "fuga", "state": "absent"},
+                    ]
+                    set_module_args({"packages": packages})
+                    apm = ApmModule()
+
+                    expected = (0, False)
+                    actual = apm.packages_apply(apm.module.params["packages"])
+                    self.assertTupleEqual(expected, actual)
+                    mocked_get_outdated_packages.assert_not_called()
+                    mocked_run_command.assert_not_called()
+
+    def test_packages_apply_when_workers_set(self):
+        execute, calls = mock_execute(lambda command, env: (0, "", ""))
+        with patch.object(ApmModule, "execute", new=execute):
+            with patch.object(
+                ApmModule, "get_installed_packages"
+            ) as mocked_get_installed_packages:
+                with patch.object(
+                    ApmModule, "get_outdated_packages"
+                ) as mocked_get_outdated_packages:
+                    mocked_get_installed_packages.return_value = (
+                        0,
+                        {"fuga": "0.0.0", "foo": "0.0.0", "bar": "0.0.0"},
+                    )
+                    mocked_get_outdated_packages.return_value = (0, {"fuga": "0.0.1"})
+                    packages = [
+                        {"name": "hoge", "state": "present"},
+                        {"name": "piyo", "state": "present"},
+                        {"name": "fuga", "state": "latest"},
+                        {"name": "foo", "state": "absent"},
+                        {"name": "bar", "state": "absent"},
+                    ]
+                    set_module_args({"packages": packages, "workers": 2})
+                    apm = ApmModule()
+
+                    expected = (0, True)
+                    actual = apm.packages_apply(apm.module.params["packages"])
+                    self.assertTupleEqual(expected, actual)
+                    self.assertListEqual(
+                        sorted(
+                            [
+                                "apm install hoge --color=false",
+                                "apm install piyo --color=false",
+                                "apm upgrade fuga --confirm=false --color=false",
+                                "apm uninstall foo bar --color=false",
+                            ]
+                        ),
+                        sorted(command for command, env in calls),
+                    )
+                    caches = set(env["npm_config_cache"] for command, env in calls)
+                    self.assertLessEqual(len(caches), 2)
+                    for result in apm.results:
+                        self.assertIsInstance(result["duration"], float)
+
+    def test_packages_apply_when_workers_set_and_fail(self):
+        execute, calls = mock_execute(
+            lambda command, env: (
+                (1, "", "error detail") if "piyo" in command else (0, "", "")
+            )
+        )
+        with patch.object(ApmModule, "execute", new=execute):
+            with patch.object(
+                ApmModule, "get_installed_packages"
+            ) as mocked_get_installed_packages:
+                mocked_get_installed_packages.return_value = (0, {})
+                packages = [{"name": "hoge"}, {"name": "piyo"}, {"name": "fuga"}]
+                set_module_args({"packages": packages, "workers": 3})
+                apm = ApmModule()
+
+                expected = (1, True)
+                actual = apm.packages_apply(apm.module.params["packages"])
+                self.assertTupleEqual(expected, actual)
+                self.assertEqual(3, len(calls))
+                self.assertEqual("error detail", apm.stderr)
+
+    def test_run_command(self):
+        set_module_args({"name": "hoge"})
+        apm = ApmModule()
+
+        expected = (0, "/path/to/cache\n", "")
+        actual = apm.run_command(
+            "sh -c 'echo $npm_config_cache'", {"npm_config_cache": "/path/to/cache"}
+        )
+        self.assertTupleEqual(expected, actual)
+
+    def test_run_command_when_fail(self):
+        set_module_args({"name": "hoge"})
+        apm = ApmModule()
+
+        expected = (3, "out\n", "err\n")
+        actual = apm.run_command("sh -c 'echo out; echo err >&2; exit 3'")
+        self.assertTupleEqual(expected, actual)
+        self.assertEqual(127, apm.run_command("command-not-found")[0])
+
+    def test_run_command_when_timed_out(self):
+        set_module_args({"name": "hoge", "timeout": 1})
+        apm = ApmModule()
+        started = time.monotonic()
+
+        # the background sleep keeps stdout open unless the process group
+        # is terminated
+        rc, stdout, stderr = apm.run_command("sh -c 'echo start; sleep 30 & wait'")
+        self.assertEqual(124, rc)
+        self.assertEqual("start\n", stdout)
+        self.assertLess(time.monotonic() - started, 10)
+        self.assertListEqual(["sh -c 'echo start; sleep 30 & wait'"], apm.timed_out)
+
+    def test_run_command_when_deadline_exceeded(self):
+        set_module_args({"name": "hoge", "deadline": 1})
+        apm = ApmModule()
+
+        self.assertEqual(124, apm.run_command("sleep 30")[0])
+        self.assertEqual(124, apm.run_command("echo")[0])
+        self.assertListEqual(["sleep 30", "echo"], apm.timed_out)
+
+    def test_run_parallel(self):
+        set_module_args({"name": "hoge"})
+        apm = ApmModule()
+        started = time.monotonic()
+
+        actual = apm.run_parallel([("sh -c 'sleep 1; echo $TMPDIR'", None)] * 4, 2)
+        self.assertGreaterEqual(time.monotonic() - started, 2)
+        self.assertEqual(4, len(actual))
+        self.assertEqual(2, len(set(stdout for rc, stdout, stderr, d in actual)))
+
+    def test_plan_packages(self):
+        with patch.object(
+            ApmModule, "get_installed_packages"
+        ) as mocked_get_installed_packages:
+            with patch.object(
+                ApmModule, "get_outdated_packages"
+            ) as mocked_get_outdated_packages:
+                mocked_get_installed_packages.return_value = (
+                    0,
+                    {"fuga": "0.0.0", "piyo": "1.0.0"},
+                )
+                mocked_get_outdated_packages.return_value = (0, {"fuga": "0.0.1"})
+                set_module_args({"name": "hoge"})
+                apm = ApmModule()
+
+                expected = (
+                    0,
+                    {
+                        "install": [{"name": "hoge", "from": None, "to": None}],
+                        "upgrade": [{"name": "fuga", "from": "0.0.0", "to": "0.0.1"}],
+                        "uninstall": [{"name": "piyo", "from": "1.0.0", "to": None}],
+                    },
+                )
+                actual = apm.plan_packages(
+                    {"hoge": "present", "fuga": "latest", "piyo": "absent"}
+                )
+                self.assertTupleEqual(expected, actual)
+                self.assertDictEqual(
+                    {
+                        "before": "fuga@0.0.0\npiyo@1.0.0\n",
+                        "after": "fuga@0.0.1\nhoge@latest\n",
+                    },
+                    apm.get_diff(actual[1]),
+                )
+
+    def test_plan_packages_when_pinned(self):
+        with patch.object(
+            ApmModule, "get_installed_packages"
+        ) as mocked_get_installed_packages:
+            with patch.object(
+                ApmModule, "get_outdated_packages"
+            ) as mocked_get_outdated_packages:
+                mocked_get_installed_packages.return_value = (
+                    0,
+                    {"fuga": "0.0.0", "piyo": "1.0.0"},
+                )
+                set_module_args({"name": "hoge"})
+                apm = ApmModule()
+
+                expected = (
+                    0,
+                    {
+                        "install": [
+                            {"name": "hoge", "from": None, "to": "2.0.0"},
+                            {"name": "fuga", "from": "0.0.0", "to": "0.0.2"},
+                        ],
+                        "upgrade": [],
+                        "uninstall": [],
+                    },
+                )
+                actual = apm.plan_packages(
+                    {"hoge": "present", "fuga": "latest", "piyo": "latest"},
+                    {"hoge": "2.0.0", "fuga": "0.0.2", "piyo": "1.0.0"},
+                )
+                self.assertTupleEqual(expected, actual)
+                mocked_get_outdated_packages.assert_not_called()
+
+    def test_read_lockfile(self):
+        path = os.path.join(self.atom_home.name, "atom.lock")
+        with open(path, "w") as f:
+            json.dump({"packages": {"hoge": "1.0.0"}}, f)
+        set_module_args({"packages": [{"name": "hoge"}], "lockfile": path})
+        apm = ApmModule()
+
+        self.assertTupleEqual((0, {"hoge": "1.0.0"}), apm.read_lockfile())
+
+        with open(path, "w") as f:
+            f.write("{")
+        self.assertEqual(1, apm.read_lockfile()[0])
+
+    def test_packages_apply_when_lockfile_set(self):
+        with patch.object(ApmModule, "run_command") as mocked_run_command:
+            path = os.path.join(self.atom_home.name, "atom.lock")
+            with open(path, "w") as f:
+                json.dump({"packages": {"hoge": "1.0.0"}}, f)
+            write_package(self.atom_home.name, "hoge", "0.9.0")
+
+            def install(command, **kwargs):
+                write_package(self.atom_home.name, "hoge", "1.0.0")
+                return (0, "", "")
+
+            mocked_run_command.side_effect = install
+            packages = [{"name": "hoge"}]
+            set_module_args({"packages": packages, "lockfile": path})
+            apm = ApmModule()
+
+            expected = (0, True)
+            actual = apm.packages_apply(apm.module.params["packages"])
+            self.assertTupleEqual(expected, actual)
+            mocked_run_command.assert_called_once_with(
+                "apm install hoge@1.0.0 --color=false"
+            )
+
+    def test_packages_apply_when_lockfile_not_exists(self):
+        with patch.object(ApmModule, "run_command") as mocked_run_command:
+            path = os.path.join(self.atom_home.name, "atom.lock")
+            write_package(self.atom_home.name, "hoge", "1.0.0")
+            write_package(self.atom_home.name, "fuga", "0.1.0")
+            packages = [{"name": "hoge"}, {"name": "fuga", "state": "present"}]
+            set_module_args({"packages": packages, "lockfile": path})
+            apm = ApmModule()
+
+            expected = (0, True)
+            actual = apm.packages_apply(apm.module.params["packages"])
+            self.assertTupleEqual(expected, actual)
+            mocked_run_command.assert_not_called()
+            with open(path) as f:
+                self.assertDictEqual(
+                    {"packages": {"hoge": "1.0.0", "fuga": "0.1.0"}}, json.load(f)
+                )
+
+    def test_packages_apply_when_stamp_fresh(self):
+        with patch.object(ApmModule, "run_command") as mocked_run_command:
+            with patch.object(ApmModule, "plan_packages") as mocked_plan_packages:
+                mocked_plan_packages.return_value = (
+                    0,
+                    {"install": [], "upgrade": [], "uninstall": []},
+                )
+                write_package(self.atom_home.name, "hoge", "1.0.0")
+                packages = [{"name": "hoge"}]
+                set_module_args({"packages": packages})
+                apm = ApmModule()
+
+                expected = (0, False)
+                self.assertTupleEqual(expected, apm.packages_apply(packages))
+                self.assertTupleEqual(expected, apm.packages_apply(packages))
+                self.assertEqual(1, mocked_plan_packages.call_count)
+
+                # manifest is changed
+                packages = [{"name": "hoge"}, {"name": "fuga", "state": "absent"}]
+                self.assertTupleEqual(expected, apm.packages_apply(packages))
+                self.assertEqual(2, mocked_plan_packages.call_count)
+
+                # installed packages are changed
+                write_package(self.atom_home.name, "piyo", "1.0.0")
+                self.assertTupleEqual(expected, apm.packages_apply(packages))
+                self.assertEqual(3, mocked_plan_packages.call_count)
+                mocked_run_command.assert_not_called()
+
+    def test_packages_apply_when_stamp_fresh_and_state_latest(self):
+        with patch.object(ApmModule, "plan_packages") as mocked_plan_packages:
+            mocked_plan_packages.return_value = (
+                0,
+                {"install": [], "upgrade": [], "uninstall": []},
+            )
+            write_package(self.atom_home.name, "hoge", "1.0.0")
+            packages = [{"name": "hoge", "state": "latest"}]
+            set_module_args({"packages": packages})
+            apm = ApmModule()
+
+            apm.packages_apply(packages)
+            apm.packages_apply(packages)
+            self.assertEqual(2, mocked_plan_packages.call_count)
+
+            set_module_args({"packages": packages, "outdated_cache_ttl": 3600})
+            apm = ApmModule()
+            apm.packages_apply(packages)
+            self.assertEqual(2, mocked_plan_packages.call_count)
+
+    def test_main_when_check_mode(self):
+        with captured_stdout() as stdout:
+            with patch.object(ApmModule, "run_command") as mocked_run_command:
+                with patch.object(
+                    ApmModule, "get_installed_packages"
+                ) as mocked_get_installed_packages:
+                    mocked_get_installed_packages.return_value = (0, {"fuga": "0.0.0"})
+                    packages = [{"name": "hoge"}, {"name": "fuga", "state": "absent"}]
+
+                    try:
+                        set_module_args(
+                            {"packages": packages, "_ansible_check_mode": True}
+                        )
+                        apm = ApmModule()
+                        apm.main()
+                    except SystemExit:
+                        actual = json.loads(stdout.getvalue())
+                        mocked_run_command.assert_not_called()
+                        self.assertEqual(True, actual["changed"])
+                        self.assertEqual("hoge", actual["plan"]["install"][0]["name"])
+                        self.assertEqual("fuga", actual["plan"]["uninstall"][0]["name"])
+                        self.assertEqual("fuga@0.0.0\n", actual["diff"]["before"])
+                        self.assertDictEqual(
+                            {"disable": [], "enable": []},
+                            {k: actual["plan"][k] for k in ("disable", "enable")},
+                        )
+
+    def test_main_when_packages_set(self):
+        with captured_stdout() as stdout:
+            with patch.object(ApmModule, "packages_apply") as mocked_packages_apply:
+                mocked_packages_apply.return_value = (0, True)
+                packages = [{"name": "hoge"}]
+
+                try:
+                    set_module_args({"packages": packages})
+                    apm = ApmModule()
+                    apm.main()
+                except SystemExit:
+                    actual = json.loads(stdout.getvalue())
+                    mocked_packages_apply.assert_called_with(
+                        [
+                            {
+                                "name": "hoge",
+                                "state": None,
+                                "source": None,
+                                "repo": None,
+                                "version": None,
+                            }
+                        ]
+                    )
+                    self.assertEqual(True, actual["changed"])
+                    self.assertEqual(0, actual["rc"])
+
+    def test_run_when_name_and_packages_set(self):
+        with captured_stdout() as stdout:
+
+            try:
+                set_module_args({"name": "hoge", "packages": [{"name": "fuga"}]})
+                ApmModule()
+            except SystemExit:
+                actual = json.loads(stdout.getvalue())
+                self.assertEqual(True, actual["failed"])
+
+    def test_main_when_timed_out(self):
+        with captured_stdout() as stdout:
+            with patch.object(ApmModule, "package_install") as mocked_package_install:
+                mocked_package_install.return_value = (124, True)
+
+                try:
+                    set_module_args({"name": "hoge", "timeout": 1})
+                    apm = ApmModule()
+                    apm.timed_out.append("apm install hoge --color=false")
+                    apm.main()
+                except SystemExit:
+                    actual = json.loads(stdout.getvalue())
+                    self.assertEqual(True, actual["failed"])
+                    self.assertEqual(
+                        "command timed out: apm install hoge --color=false",
+                        actual["msg"],
+                    )
+
+    def test_main_returns_metrics(self):
+        with captured_stdout() as stdout:
+            write_package(self.atom_home.name, "hoge", "0.0.0")
+            packages = [{"name": "hoge"}, {"name": "fuga", "state": "absent"}]
+
+            try:
+                set_module_args({"packages": packages})
+                apm = ApmModule()
+                apm.main()
+            except SystemExit:
+                metrics = json.loads(stdout.getvalue())["metrics"]
+                self.assertIn("installed", metrics["phases"])
+                self.assertEqual(0, metrics["subprocesses"])
+                self.assertDictEqual(
+                    {
+                        "installed": {"hit": 2, "miss": 1},
+                        "stamp": {"hit": 0, "miss": 1},
+                    },
+                    metrics["cache"],
+                )
+                self.assertGreater(metrics["total"], 0)
+
+    def test_execute_records_metrics(self):
+        set_module_args({"name": "hoge"})
+        apm = ApmModule()
+
+        apm.run_command("echo hoge")
+        metrics = apm.get_metrics()
+        self.assertEqual(1, metrics["subprocesses"])
+        self.assertEqual("echo hoge", metrics["commands"][0]["command"])
+        self.assertEqual(0, metrics["commands"][0]["rc"])
+        self.assertEqual(5, metrics["output_bytes"])
+
+    def test_run_module_when_profile_set(self):
+        with captured_stdout():
+            with patch.dict(os.environ, {"ANSIBLE_APM_PROFILE": self.atom_home.name}):
+                set_module_args({"packages": [{"name": "hoge", "state": "absent"}]})
+                write_package(self.atom_home.name, "fuga", "0.0.0")
+
+                with self.assertRaises(SystemExit):
+                    run_module()
+                profiles = [
+                    f for f in os.listdir(self.atom_home.name) if f.endswith(".prof")
+                ]
+                self.assertEqual(1, len(profiles))
+
     def test_run_when_name_not_set(self):
         with captured_stdout() as stdout:
 
@@ -289,5 +1536,509 @@ class TestApmModule(unittest.TestCase):
                 self.assertEqual(True, actual["failed"])
 
 
+class TestApmModuleArtifactCache(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.root.cleanup)
+        self.atom_home = os.path.join(self.root.name, "atom")
+        self.cache = os.path.join(self.root.name, "cache")
+        patcher = patch.dict(os.environ, {"ATOM_HOME": self.atom_home})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        os.makedirs(os.path.join(self.root.name, "registry"))
+        self.registry = Registry(os.path.join(self.root.name, "registry")).start()
+        self.addCleanup(self.registry.stop)
+        self.registry.add_package("hoge", "1.0.0", {"index.js": "1"})
+        self.registry.add_package("hoge", "1.1.0", {"index.js": "2"})
+
+    def create_module(self, args):
+        set_module_args(
+            dict(
+                args,
+                registry_url=self.registry.url,
+                artifact_cache=self.cache,
+            )
+        )
+        return ApmModule()
+
+    def test_fetch_artifact(self):
+        apm = self.create_module({"name": "hoge"})
+
+        rc, version, path = apm.fetch_artifact("hoge")
+        self.assertEqual((0, "1.1.0"), (rc, version))
+        self.assertTrue(path.startswith(self.cache))
+        self.assertListEqual(
+            ["/packages/hoge", "/tarballs/hoge-1.1.0.tgz"], self.registry.requests
+        )
+
+        # cached artifact is used without requests to the registry
+        self.assertTupleEqual((0, "1.1.0", path), apm.fetch_artifact("hoge", "1.1.0"))
+        self.assertEqual(2, len(self.registry.requests))
+
+    def test_fetch_artifact_when_shared(self):
+        apm = self.create_module({"name": "hoge"})
+
+        rc, version, path = apm.fetch_artifact("hoge")
+        directories = [
+            self.cache,
+            os.path.join(self.cache, "index"),
+            os.path.join(self.cache, "blobs"),
+            os.path.dirname(path),
+        ]
+        for directory in directories:
+            self.assertEqual(0o2775, os.stat(directory).st_mode & 0o7777)
+
+    def test_fetch_artifact_when_not_cached(self):
+        apm = self.create_module({"name": "hoge"})
+        make_artifact_directory = apm.make_artifact_directory
+
+        def fail_on_blob(path):
+            if os.path.dirname(path) == os.path.join(self.cache, "blobs"):
+                raise OSError("denied")
+            make_artifact_directory(path)
+
+        # the download is removed and the package is left to apm
+        with patch.object(apm, "make_artifact_directory", side_effect=fail_on_blob):
+            with patch.object(apm.module, "warn") as mocked_warn:
+                self.assertTupleEqual((0, "1.1.0", None), apm.fetch_artifact("hoge"))
+                self.assertIn("denied", mocked_warn.call_args[0][0])
+        self.assertListEqual([], os.listdir(os.path.join(self.cache, "blobs")))
+
+        with patch.object(ApmModule, "run_command") as mocked_run_command:
+            mocked_run_command.return_value = (0, "", "")
+            with open(os.path.join(self.root.name, "file"), "w"):
+                pass
+            self.cache = os.path.join(self.root.name, "file", "cache")
+            apm = self.create_module({"packages": [{"name": "hoge"}]})
+
+            actual = apm.packages_apply(apm.module.params["packages"])
+            self.assertTupleEqual((0, True), actual)
+            mocked_run_command.assert_called_with("apm install hoge --color=false")
+
+    def test_fetch_artifact_when_not_found(self):
+        apm = self.create_module({"name": "fuga"})
+
+        rc, version, path = apm.fetch_artifact("fuga")
+        self.assertEqual(1, rc)
+        self.assertIsNone(path)
+
+    def test_get_outdated_packages_when_outdated_source_registry(self):
+        with patch.object(ApmModule, "run_command") as mocked_run_command:
+            self.registry.add_package("piyo", "2.0.0")
+            write_package(self.atom_home, "hoge", "1.0.0")
+            write_package(self.atom_home, "fuga", "1.0.0")
+            write_package(self.atom_home, "piyo", "1.0.0")
+            apm = self.create_module({"name": "hoge", "outdated_source": "registry"})
+
+            # only the given packages are looked up, fuga is not in the registry
+            actual = apm.get_outdated_packages(["hoge", "fuga"])
+            self.assertTupleEqual((0, {"hoge": "1.1.0"}), actual)
+            self.assertListEqual(
+                ["/packages/fuga", "/packages/hoge"], sorted(self.registry.requests)
+            )
+            mocked_run_command.assert_not_called()
+
+            # metadata is revalidated by ETag
+            actual = apm.get_outdated_packages(["hoge"])
+            self.assertTupleEqual((0, {"hoge": "1.1.0"}), actual)
+            self.assertEqual(304, self.registry.statuses[-1])
+
+    def test_get_outdated_packages_when_outdated_source_registry_and_facts(self):
+        with patch.object(ApmModule, "run_command") as mocked_run_command:
+            write_package(self.atom_home, "hoge", "1.0.0")
+            facts = {
+                "atom_home": self.atom_home,
+                "mtime": os.stat(os.path.join(self.atom_home, "packages")).st_mtime_ns,
+                "time": time.time(),
+                "installed": {"hoge": {"version": "1.0.0"}},
+                "outdated": {"fuga": "2.0.0"},
+            }
+            apm = self.create_module(
+                {"name": "hoge", "outdated_source": "registry", "facts": facts}
+            )
+
+            actual = apm.get_outdated_packages(["hoge"])
+            self.assertTupleEqual((0, {"hoge": "1.1.0"}), actual)
+            self.assertListEqual(["/packages/hoge"], self.registry.requests)
+            mocked_run_command.assert_not_called()
+
+    def test_get_outdated_packages_when_outdated_source_registry_and_cached(self):
+        write_package(self.atom_home, "hoge", "1.0.0")
+        apm = self.create_module(
+            {"name": "hoge", "outdated_source": "registry", "outdated_cache_ttl": 60}
+        )
+
+        self.assertTupleEqual(
+            (0, {"hoge": "1.1.0"}), apm.get_outdated_packages(["hoge"])
+        )
+        self.assertTupleEqual(
+            (0, {"hoge": "1.1.0"}), apm.get_outdated_packages(["hoge"])
+        )
+        self.assertEqual(1, len(self.registry.requests))
+        self.assertEqual({"hit": 1, "miss": 1}, apm.metrics["cache"]["registry"])
+
+    def test_request_packages(self):
+        names = ["package-{0}".format(number) for number in range(10)]
+        for name in names:
+            self.registry.add_package(name, "1.0.0")
+        apm = self.create_module({"name": "hoge", "registry_connections": 2})
+
+        rc, responses = apm.request_packages(names, {})
+        self.assertEqual(0, rc)
+        self.assertListEqual(names, list(responses))
+        self.assertTrue(all(status == 200 for status, _, _ in responses.values()))
+        # requests share kept-alive connections
+        self.assertLessEqual(self.registry.connections, 2)
+
+    def test_request_packages_when_proxy_set(self):
+        self.registry.add_package("hoge", "1.0.0")
+        environ = {"http_proxy": self.registry.url, "no_proxy": ""}
+        with patch.dict(os.environ, environ):
+            set_module_args({"name": "hoge", "registry_url": "http://registry.invalid"})
+            apm = ApmModule()
+
+            rc, responses = apm.request_packages(["hoge"], {})
+            self.assertEqual(0, rc)
+            self.assertEqual(200, responses["hoge"][0])
+            self.assertListEqual(
+                ["http://registry.invalid/packages/hoge"], self.registry.requests
+            )
+
+        # hosts in no_proxy are not requested through the proxy
+        environ = {"http_proxy": "http://127.0.0.1:9", "no_proxy": "127.0.0.1"}
+        with patch.dict(os.environ, environ):
+            apm = self.create_module({"name": "hoge"})
+
+            rc, responses = apm.request_packages(["hoge"], {})
+            self.assertEqual(0, rc)
+            self.assertEqual("/packages/hoge", self.registry.requests[-1])
+
+    def test_get_registry_proxy(self):
+        environ = {"https_proxy": "user:p%40ss@proxy:3128", "no_proxy": "atom.io"}
+        with patch.dict(os.environ, environ):
+            apm = self.create_module({"name": "hoge"})
+
+            netloc, headers = apm.get_registry_proxy(urlsplit("https://example.com"))
+            self.assertEqual("proxy:3128", netloc)
+            self.assertEqual(
+                "Basic " + base64.b64encode(b"user:p@ss").decode("ascii"),
+                headers["Proxy-Authorization"],
+            )
+            self.assertIsNone(apm.get_registry_proxy(urlsplit("https://atom.io")))
+
+    def test_evict_artifacts(self):
+        apm = self.create_module({"name": "hoge"})
+        rc, version, old = apm.fetch_artifact("hoge", "1.0.0")
+        rc, version, new = apm.fetch_artifact("hoge", "1.1.0")
+        os.utime(old, (0, 0))
+
+        apm.evict_artifacts(os.path.getsize(new))
+        self.assertFalse(os.path.exists(old))
+        self.assertTrue(os.path.exists(new))
+
+        # the artifact is downloaded again after eviction
+        self.assertEqual(0, apm.fetch_artifact("hoge", "1.0.0")[0])
+        self.assertTrue(os.path.exists(old))
+
+    def test_packages_apply(self):
+        with patch.object(ApmModule, "run_command") as mocked_run_command:
+            mocked_run_command.return_value = (0, "", "")
+            write_package(self.atom_home, "fuga", "0.0.0")
+            apm = self.create_module({"packages": [{"name": "hoge"}]})
+
+            expected = (0, True)
+            actual = apm.packages_apply(apm.module.params["packages"])
+            self.assertTupleEqual(expected, actual)
+            command, kwargs = mocked_run_command.call_args
+            self.assertTupleEqual(("apm install --color=false",), command)
+            self.assertTrue(kwargs["cwd"].endswith(os.path.join("hoge", "package")))
+            with open(
+                os.path.join(self.atom_home, "packages", "hoge", "index.js")
+            ) as f:
+                self.assertEqual("2", f.read())
+            self.assertListEqual(
+                [], os.listdir(os.path.join(self.atom_home, ".ansible-apm", "staging"))
+            )
+
+    def test_packages_apply_when_install_failed(self):
+        with patch.object(ApmModule, "run_command") as mocked_run_command:
+            mocked_run_command.return_value = (1, "", "error detail")
+            write_package(self.atom_home, "hoge", "0.0.0")
+            apm = self.create_module(
+                {"packages": [{"name": "hoge", "state": "latest"}]}
+            )
+
+            with patch.object(ApmModule, "get_outdated_packages") as mocked_outdated:
+                mocked_outdated.return_value = (0, {"hoge": "1.1.0"})
+                actual = apm.packages_apply(apm.module.params["packages"])
+
+            self.assertTupleEqual((1, True), actual)
+            self.assertEqual("0.0.0", apm.get_package_index()["hoge"])
+
+    def write_tarball(self, name, version, members):
+        """
+        replace the tarball of name@version in the registry with members of
+        (TarInfo, content)
+        """
+        path = os.path.join(
+            self.root.name, "registry", "tarballs", "{0}-{1}.tgz".format(name, version)
+        )
+        with tarfile.open(path, "w:gz") as archive:
+            for info, content in members:
+                info.size = len(content)
+                archive.addfile(info, io.BytesIO(content))
+
+    def test_stage_package(self):
+        self.registry.add_package("fuga", "1.0.0")
+        self.write_tarball(
+            "fuga",
+            "1.0.0",
+            [
+                (tarfile.TarInfo("package/package.json"), b"{}"),
+                (tarfile.TarInfo("package/..fuga"), b"1"),
+            ],
+        )
+        apm = self.create_module({"name": "fuga"})
+        staging = os.path.join(self.root.name, "staging")
+
+        rc, path = apm.stage_package("fuga", "1.0.0", staging)
+        self.assertEqual(0, rc)
+        self.assertTrue(os.path.isfile(os.path.join(path, "..fuga")))
+
+    def test_stage_package_when_link_in_tarball(self):
+        outside = os.path.join(self.root.name, "outside")
+        os.makedirs(outside)
+        link = tarfile.TarInfo("package/link")
+        link.type, link.linkname = (tarfile.SYMTYPE, outside)
+        self.registry.add_package("fuga", "1.0.0")
+        self.write_tarball(
+            "fuga",
+            "1.0.0",
+            [
+                (tarfile.TarInfo("package/package.json"), b"{}"),
+                (link, b""),
+                (tarfile.TarInfo("package/link/evil"), b"1"),
+            ],
+        )
+        apm = self.create_module({"name": "fuga"})
+        staging = os.path.join(self.root.name, "staging")
+
+        rc, path = apm.stage_package("fuga", "1.0.0", staging)
+        self.assertEqual(1, rc)
+        self.assertIn("unsafe member package/link", apm.stderr)
+        self.assertListEqual([], os.listdir(outside))
+
+        # members that resolve outside of the destination are rejected too
+        self.write_tarball(
+            "fuga", "1.0.0", [(tarfile.TarInfo("package/../../evil"), b"1")]
+        )
+        apm = self.create_module({"name": "fuga"})
+        shutil.rmtree(self.cache)
+        self.assertEqual(1, apm.stage_package("fuga", "1.0.0", staging)[0])
+        self.assertFalse(os.path.exists(os.path.join(self.root.name, "evil")))
+
+    def test_main_when_name_set(self):
+        with captured_stdout() as stdout:
+            with patch.object(ApmModule, "run_command") as mocked_run_command:
+                mocked_run_command.return_value = (0, "", "")
+
+                try:
+                    self.create_module({"name": "hoge"}).main()
+                except SystemExit:
+                    actual = json.loads(stdout.getvalue())
+                    self.assertEqual(True, actual["changed"])
+
+                # the package is installed through the artifact cache
+                command, kwargs = mocked_run_command.call_args
+                self.assertTupleEqual(("apm install --color=false",), command)
+                self.assertTrue(os.path.isdir(self.cache))
+                with open(
+                    os.path.join(self.atom_home, "packages", "hoge", "index.js")
+                ) as f:
+                    self.assertEqual("2", f.read())
+
+
+class TestApmModuleGit(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.root.cleanup)
+        self.atom_home = os.path.join(self.root.name, "atom")
+        self.repo = os.path.join(self.root.name, "hoge")
+        patcher = patch.dict(
+            os.environ,
+            {
+                "ATOM_HOME": self.atom_home,
+                "GIT_AUTHOR_NAME": "test",
+                "GIT_AUTHOR_EMAIL": "test@example.com",
+                "GIT_COMMITTER_NAME": "test",
+                "GIT_COMMITTER_EMAIL": "test@example.com",
+            },
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        os.makedirs(self.repo)
+        self.git("init", "--quiet")
+        self.commits = [self.commit("1.0.0"), self.commit("1.1.0")]
+        self.git("tag", "v1.0.0", self.commits[0])
+
+        # git runs for real and apm does nothing
+        self.commands = []
+        execute = ApmModule.execute
+
+        async def mocked_execute(apm, command, environ_update=None, cwd=None):
+            self.commands.append(command)
+            if command.startswith("apm "):
+                return (0, "", "", 0.0)
+            return await execute(apm, command, environ_update, cwd)
+
+        patcher = patch.object(ApmModule, "execute", mocked_execute)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def git(self, *args):
+        return subprocess.check_output(("git",) + args, cwd=self.repo).decode().strip()
+
+    def commit(self, version):
+        with open(os.path.join(self.repo, "package.json"), "w") as f:
+            json.dump({"name": "hoge", "version": version}, f)
+        self.git("add", "package.json")
+        self.git("commit", "--quiet", "-m", version)
+        return self.git("rev-parse", "HEAD")
+
+    def create_module(self, package):
+        set_module_args(
+            {"packages": [dict(package, name="hoge", source="git", repo=self.repo)]}
+        )
+        return ApmModule()
+
+    def read_manifest(self):
+        path = os.path.join(self.atom_home, "packages", "hoge", "package.json")
+        with open(path) as f:
+            return json.load(f)
+
+    def test_packages_apply(self):
+        apm = self.create_module({"version": "v1.0.0"})
+        packages = apm.module.params["packages"]
+
+        self.assertTupleEqual((0, True), apm.packages_apply(packages))
+        manifest = self.read_manifest()
+        self.assertEqual("1.0.0", manifest["version"])
+        self.assertDictEqual(
+            {"type": "git", "source": self.repo, "sha": self.commits[0]},
+            manifest["apmInstallSource"],
+        )
+        self.assertFalse(
+            os.path.exists(os.path.join(self.atom_home, "packages", "hoge", ".git"))
+        )
+        self.assertIn("apm install --color=false", self.commands)
+
+        # the installed commit is resolved in the mirror without fetching
+        self.commands.clear()
+        os.remove(os.path.join(self.atom_home, ".ansible-apm", "stamp.json"))
+        apm = self.create_module({"version": "v1.0.0"})
+        self.assertTupleEqual((0, False), apm.packages_apply(packages))
+        self.assertListEqual(
+            ["git rev-parse --verify --quiet 'v1.0.0^{commit}'"], self.commands
+        )
+
+    def test_packages_apply_when_commit_installed(self):
+        apm = self.create_module({"version": self.commits[0]})
+        packages = apm.module.params["packages"]
+        apm.packages_apply(packages)
+
+        # git is not run at all when the installed commit is pinned
+        self.commands.clear()
+        os.remove(os.path.join(self.atom_home, ".ansible-apm", "stamp.json"))
+        apm = self.create_module({"version": self.commits[0]})
+        self.assertTupleEqual((0, False), apm.packages_apply(packages))
+        self.assertListEqual([], self.commands)
+
+    def test_packages_apply_when_latest(self):
+        apm = self.create_module({"version": "v1.0.0"})
+        apm.packages_apply(apm.module.params["packages"])
+        mirror = apm.get_git_mirror(self.repo)
+        self.commits.append(self.commit("1.2.0"))
+
+        # the mirror is fetched incrementally instead of cloned again
+        self.commands.clear()
+        apm = self.create_module({"state": "latest"})
+        self.assertTupleEqual(
+            (0, True), apm.packages_apply(apm.module.params["packages"])
+        )
+        self.assertEqual("1.2.0", self.read_manifest()["version"])
+        self.assertEqual(self.commits[2], apm.get_git_commit("hoge"))
+        self.assertIn("git fetch --prune --quiet origin", self.commands)
+        self.assertFalse(any(c.startswith("git clone") for c in self.commands))
+        self.assertTrue(os.path.isdir(mirror))
+        self.assertListEqual(
+            [{"name": "hoge", "state": "latest", "action": "upgrade", "changed": True}],
+            [
+                dict((k, r[k]) for k in ("name", "state", "action", "changed"))
+                for r in apm.results
+            ],
+        )
+
+    def run_check_mode(self, package):
+        with captured_stdout() as stdout:
+            try:
+                set_module_args(
+                    {
+                        "packages": [
+                            dict(package, name="hoge", source="git", repo=self.repo)
+                        ],
+                        "_ansible_check_mode": True,
+                    }
+                )
+                ApmModule().main()
+            except SystemExit:
+                return json.loads(stdout.getvalue())
+
+    def test_main_when_check_mode(self):
+        git = os.path.join(self.atom_home, ".ansible-apm", "git")
+
+        # the mirror is not created, and the tag is resolved by ls-remote
+        actual = self.run_check_mode({"version": "v1.0.0"})
+        self.assertEqual(True, actual["changed"])
+        self.assertListEqual(
+            [{"name": "hoge", "from": None, "to": self.commits[0]}],
+            actual["plan"]["install"],
+        )
+        self.assertFalse(os.path.exists(git))
+        self.assertListEqual(
+            ["git ls-remote"],
+            sorted(set(c[:13] for c in self.commands if c.startswith("git "))),
+        )
+
+        # the mirror is not fetched for latest state
+        apm = self.create_module({"version": "v1.0.0"})
+        apm.packages_apply(apm.module.params["packages"])
+        self.commits.append(self.commit("1.2.0"))
+        self.commands.clear()
+        actual = self.run_check_mode({"state": "latest"})
+        self.assertListEqual(
+            [{"name": "hoge", "from": self.commits[0], "to": self.commits[2]}],
+            actual["plan"]["upgrade"],
+        )
+        self.assertFalse(any("fetch" in c or "clone" in c for c in self.commands))
+
+    def test_resolve_git_commit_when_mirror_not_created(self):
+        apm = self.create_module({"version": "v1.0.0"})
+
+        with patch.object(tempfile, "mkdtemp", side_effect=OSError("denied")):
+            actual = apm.resolve_git_commit(self.repo, "v1.0.0", False)
+        self.assertTupleEqual((1, None), actual)
+        self.assertIn("denied", apm.stderr)
+
+    def test_packages_apply_when_version_not_found(self):
+        apm = self.create_module({"version": "v9.9.9"})
+
+        rc, changed = apm.packages_apply(apm.module.params["packages"])
+        self.assertEqual(1, rc)
+        self.assertFalse(changed)
+        self.assertIn("v9.9.9", apm.stderr)
+
+
 if __name__ == "__main__":
     unittest.main()
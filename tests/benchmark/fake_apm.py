@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+"""
+scriptable stand-in of apm for benchmarks
+
+installed packages are directories in $ATOM_HOME/packages like real apm,
+outdated packages are read from $ATOM_HOME/.fake-apm/outdated.json as
+name -> latest version. every invocation sleeps FAKE_APM_LATENCY seconds,
+plus FAKE_APM_PACKAGE_LATENCY seconds per installed or upgraded package,
+and is appended to FAKE_APM_LOG when it is set.
+"""
+
+import fcntl
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+
+def get_atom_home(atom_home=None):
+    return atom_home or os.environ.get("ATOM_HOME") or os.path.expanduser("~/.atom")
+
+
+def get_outdated_path(atom_home=None):
+    return os.path.join(get_atom_home(atom_home), ".fake-apm", "outdated.json")
+
+
+@contextmanager
+def lock_outdated(atom_home=None):
+    """
+    serialize read-modify-write of outdated packages between concurrent
+    invocations
+    """
+    path = get_outdated_path(atom_home)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".lock", "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+def read_outdated(atom_home=None):
+    try:
+        with open(get_outdated_path(atom_home)) as f:
+            return json.load(f)
+    except OSError:
+        return {}
+
+
+def write_outdated(outdated, atom_home=None):
+    path = get_outdated_path(atom_home)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, temporary = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".outdated")
+    with os.fdopen(fd, "w") as f:
+        json.dump(outdated, f)
+    os.replace(temporary, path)
+
+
+def read_installed():
+    installed = {}
+    directory = os.path.join(get_atom_home(), "packages")
+
+    if not os.path.isdir(directory):
+        return installed
+
+    for name in sorted(os.listdir(directory)):
+        try:
+            with open(os.path.join(directory, name, "package.json")) as f:
+                installed[name] = json.load(f)["version"]
+        except (OSError, ValueError, KeyError):
+            continue
+
+    return installed
+
+
+def write_package(name, version, atom_home=None):
+    path = os.path.join(get_atom_home(atom_home), "packages", name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    staging = tempfile.mkdtemp(dir=os.path.dirname(path), prefix="." + name)
+
+    with open(os.path.join(staging, "package.json"), "w") as f:
+        json.dump({"name": name, "version": version}, f)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(staging, path)
+
+
+def command_list(arguments):
+    installed = read_installed()
+
+    if "--json" in arguments:
+        user = [{"name": n, "version": v} for n, v in installed.items()]
+        print(json.dumps({"core": [], "dev": [], "git": [], "user": user}))
+    else:
+        for name, version in installed.items():
+            print("{0}@{1}".format(name, version))
+
+
+def pop_outdated(name):
+    """
+    remove name from outdated packages, returns its latest version
+    """
+    with lock_outdated():
+        outdated = read_outdated()
+        version = outdated.pop(name, None)
+        if version is not None:
+            write_outdated(outdated)
+
+    return version
+
+
+def command_install(arguments):
+    latency = float(os.environ.get("FAKE_APM_PACKAGE_LATENCY", "0"))
+
+    # `apm install` without names installs dependencies in the current
+    # directory
+    for target in arguments:
+        name, separator, version = target.partition("@")
+        time.sleep(latency)
+        write_package(name, version or pop_outdated(name) or "1.0.0")
+        print("Installing {0} to {1} ✓".format(target, get_atom_home()))
+
+
+def command_upgrade(arguments, flags):
+    latency = float(os.environ.get("FAKE_APM_PACKAGE_LATENCY", "0"))
+    outdated = read_outdated()
+    installed = read_installed()
+    updates = [(n, installed[n], v) for n, v in outdated.items() if n in installed]
+
+    if "--list" in flags:
+        if "--json" in flags:
+            packages = [
+                {"name": n, "version": current, "latestVersion": latest}
+                for n, current, latest in updates
+            ]
+            print(json.dumps(packages))
+        else:
+            print("Package Updates Available ({0})".format(len(updates)))
+            for name, current, latest in updates:
+                print("└── {0} {1} -> {2}".format(name, current, latest))
+        return
+
+    for name in arguments:
+        version = pop_outdated(name)
+        if version is not None:
+            time.sleep(latency)
+            write_package(name, version)
+            print("Installing {0}@{1} to {2} ✓".format(name, version, get_atom_home()))
+
+
+def command_uninstall(arguments):
+    for name in arguments:
+        path = os.path.join(get_atom_home(), "packages", name)
+        if not os.path.exists(path):
+            sys.stderr.write("Failed to delete {0}: not installed\n".format(name))
+            return 1
+        shutil.rmtree(path)
+        print("Uninstalling {0} ✓".format(name))
+
+
+def main(argv):
+    if os.environ.get("FAKE_APM_LOG"):
+        with open(os.environ["FAKE_APM_LOG"], "a") as f:
+            f.write(json.dumps(argv) + "\n")
+
+    time.sleep(float(os.environ.get("FAKE_APM_LATENCY", "0")))
+
+    command = argv[0] if argv else "help"
+    arguments = [a for a in argv[1:] if not a.startswith("--")]
+    flags = [a for a in argv[1:] if a.startswith("--")]
+    commands = {
+        "list": lambda: command_list(flags),
+        "install": lambda: command_install(arguments),
+        "upgrade": lambda: command_upgrade(arguments, flags),
+        "uninstall": lambda: command_uninstall(arguments),
+        "rebuild": lambda: None,
+    }
+
+    if command not in commands:
+        sys.stderr.write("unknown command {0}\n".format(command))
+        return 1
+
+    return commands[command]() or 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+"""
+benchmark of the apm module and the role with a fake apm
+
+every scenario starts from an ATOM_HOME that has half of the packages
+installed and a tenth of the installed packages outdated, then converges
+twice: the first run does the work and the second run is a no-op.
+
+    python -m tests.benchmark.run --packages 10 100 --output results.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from tests.benchmark.fake_apm import write_package, write_outdated
+from tests.registry import Registry
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+MIXES = {
+    "present": ["present"],
+    "latest": ["latest"],
+    "absent": ["absent"],
+    "mixed": ["present", "latest", "absent"],
+}
+BOOTSTRAP = """
+import runpy, tests
+runpy.run_path({0!r}, run_name="__main__")
+""".format(os.path.join(ROOT, "library", "apm.py"))
+PLAYBOOK = """---
+- hosts: localhost
+  connection: local
+  gather_facts: no
+  roles:
+    - {root}
+"""
+
+
+def create_fake_apm(directory):
+    """
+    create `apm` that runs fake_apm.py in directory
+    """
+    path = os.path.join(directory, "apm")
+
+    with open(path, "w") as f:
+        f.write(
+            '#!/bin/sh\nexec "{0}" "{1}" "$@"\n'.format(
+                sys.executable, os.path.join(ROOT, "tests", "benchmark", "fake_apm.py")
+            )
+        )
+    os.chmod(path, 0o755)
+
+
+def prepare_atom_home(atom_home, count):
+    """
+    install the first half of packages and mark a tenth of them outdated,
+    returns names of packages
+    """
+    names = ["package-{0:04d}".format(number) for number in range(count)]
+    installed = names[: count // 2]
+
+    for name in installed:
+        write_package(name, "1.0.0", atom_home)
+    write_outdated(dict((name, "1.1.0") for name in installed[::10]), atom_home)
+
+    return names
+
+
+def count_lines(path):
+    try:
+        with open(path) as f:
+            return sum(1 for line in f)
+    except OSError:
+        return 0
+
+
+def run_process(command, env, cwd=None):
+    """
+    returns returncode, stdout, wall time and peak rss in kilobytes of
+    the process and its waited descendants
+    """
+    started = time.monotonic()
+    process = subprocess.Popen(
+        command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env, cwd=cwd
+    )
+    stdout = process.stdout.read()
+    _, status, usage = os.wait4(process.pid, 0)
+    process.stdout.close()
+    process.returncode = (
+        os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    )
+
+    # ru_maxrss is in bytes on macOS
+    peak_rss = usage.ru_maxrss
+    if sys.platform == "darwin":
+        peak_rss //= 1024
+
+    return (process.returncode, stdout, time.monotonic() - started, peak_rss)
+
+
+def run_module(directory, args, env):
+    path = os.path.join(directory, "args.json")
+
+    with open(path, "w") as f:
+        json.dump({"ANSIBLE_MODULE_ARGS": args}, f)
+
+    # importing tests adds module_utils of the role like ansible does
+    command = [sys.executable, "-c", BOOTSTRAP, path]
+    rc, stdout, wall, peak_rss = run_process(command, env, cwd=ROOT)
+    try:
+        result = json.loads(stdout)
+    except ValueError:
+        result = {"failed": True, "msg": stdout.decode("utf-8", "replace")}
+
+    return (rc, result.get("changed", False), wall, peak_rss, result)
+
+
+def run_role(directory, args, env):
+    playbook = os.path.join(directory, "playbook.yml")
+    extra_vars = os.path.join(directory, "vars.json")
+
+    with open(playbook, "w") as f:
+        f.write(PLAYBOOK.format(root=ROOT))
+    with open(extra_vars, "w") as f:
+        json.dump({"atom": dict(args, skip_install=True)}, f)
+
+    command = [
+        "ansible-playbook",
+        "-i",
+        "localhost,",
+        playbook,
+        "-e",
+        "@" + extra_vars,
+    ]
+    rc, stdout, wall, peak_rss = run_process(command, env)
+    changed = b"changed=1" in stdout
+
+    return (rc, changed, wall, peak_rss, {"stdout": stdout.decode("utf-8")})
+
+
+def run_scenario(options, mode, count, mix, registry=None):
+    results = []
+
+    with tempfile.TemporaryDirectory(prefix="apm-benchmark-") as directory:
+        bin_directory = os.path.join(directory, "bin")
+        log = os.path.join(directory, "apm.log")
+        os.makedirs(bin_directory)
+        create_fake_apm(bin_directory)
+
+        names = prepare_atom_home(os.path.join(directory, "atom"), count)
+        states = MIXES[mix]
+        packages = [
+            {"name": name, "state": states[number % len(states)]}
+            for number, name in enumerate(names)
+        ]
+        args = {"packages": packages, "workers": options.workers}
+        if registry:
+            # the registry agrees with the fake apm on outdated packages
+            outdated = set(names[: count // 2][::10])
+            args["registry_url"] = registry.url
+            args["artifact_cache"] = os.path.join(directory, "cache")
+            args["outdated_source"] = "registry"
+            for name in names:
+                registry.add_package(name, "1.1.0" if name in outdated else "1.0.0")
+
+        env = dict(
+            os.environ,
+            PATH=bin_directory + os.pathsep + os.environ.get("PATH", ""),
+            ATOM_HOME=os.path.join(directory, "atom"),
+            FAKE_APM_LOG=log,
+            FAKE_APM_LATENCY=str(options.latency),
+            FAKE_APM_PACKAGE_LATENCY=str(options.package_latency),
+            PYTHONPATH=ROOT,
+        )
+        runner = run_module if mode == "module" else run_role
+
+        for phase in ("converge", "noop"):
+            before = count_lines(log)
+            rc, changed, wall, peak_rss, result = runner(directory, args, env)
+            results.append(
+                {
+                    "mode": mode,
+                    "packages": count,
+                    "mix": mix,
+                    "registry": registry is not None,
+                    "phase": phase,
+                    "rc": rc,
+                    "changed": changed,
+                    "wall": round(wall, 4),
+                    "subprocesses": count_lines(log) - before,
+                    "peak_rss_kb": peak_rss,
+                }
+            )
+            if rc != 0 and options.verbose:
+                sys.stderr.write(json.dumps(result, indent=2) + "\n")
+
+    return results
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--packages", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--mixes", nargs="+", choices=list(MIXES), default=list(MIXES))
+    parser.add_argument(
+        "--modes", nargs="+", choices=["module", "role"], default=["module"]
+    )
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument(
+        "--latency", type=float, default=0.2, help="seconds per apm invocation"
+    )
+    parser.add_argument(
+        "--package-latency", type=float, default=0.0, help="seconds per package"
+    )
+    parser.add_argument(
+        "--registry",
+        action="store_true",
+        help="look up outdated packages and install through the artifact cache "
+        "from a local registry",
+    )
+    parser.add_argument("--output", help="path to write results as json")
+    parser.add_argument("--verbose", action="store_true")
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    options = parse_args(argv)
+    results = []
+    registry = None
+
+    if options.registry:
+        registry_directory = tempfile.TemporaryDirectory(prefix="apm-registry-")
+        registry = Registry(registry_directory.name).start()
+
+    try:
+        for mode in options.modes:
+            for count in options.packages:
+                for mix in options.mixes:
+                    results.extend(run_scenario(options, mode, count, mix, registry))
+    finally:
+        if registry:
+            registry.stop()
+            registry_directory.cleanup()
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.time(),
+        "options": vars(options),
+        "self_peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+
+    if options.output:
+        with open(options.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    return 1 if any(result["rc"] != 0 for result in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+
+import json
+import os
+import tempfile
+import unittest
+
+from tests.benchmark import run
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_run_module(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, "results.json")
+            argv = ["--packages", "10", "--latency", "0", "--output", output]
+
+            atom_home = os.environ.get("ATOM_HOME")
+            self.assertEqual(0, run.main(argv))
+            self.assertEqual(atom_home, os.environ.get("ATOM_HOME"))
+            with open(output) as f:
+                results = json.load(f)["results"]
+
+            self.assertEqual(8, len(results))
+            for result in results:
+                expected = result["phase"] == "converge"
+                self.assertEqual(expected, result["changed"])
+                self.assertGreater(result["peak_rss_kb"], 0)
+
+            # no-op runs of packages in present or absent state don't start apm
+            noop = [r for r in results if r["phase"] == "noop"]
+            self.assertListEqual(
+                [0, 1, 0, 1], [result["subprocesses"] for result in noop]
+            )
+
+    def test_run_module_when_workers_set(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, "results.json")
+            argv = ["--packages", "40", "--latency", "0", "--workers", "4"]
+            argv += ["--mixes", "present", "latest", "--output", output]
+
+            # parallel installs of the fake apm share outdated packages
+            self.assertEqual(0, run.main(argv))
+            with open(output) as f:
+                results = json.load(f)["results"]
+            self.assertTrue(all(result["rc"] == 0 for result in results))
+
+
+if __name__ == "__main__":
+    unittest.main()
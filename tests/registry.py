@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+import io
+import json
+import os
+import tarfile
+import threading
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+
+class RequestHandler(SimpleHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    etag = None
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def log_request(self, code="-", size="-"):
+        self.server.requests.append(self.path)
+        self.server.statuses.append(int(code))
+
+    def log_message(self, format, *args):
+        pass
+
+    def translate_path(self, path):
+        # requests through a proxy have absolute urls, so the registry
+        # serves as a proxy of itself
+        return super().translate_path(urlsplit(path).path)
+
+    def send_head(self):
+        # files are revalidated by ETag, that is made of mtime and size
+        path = self.translate_path(self.path)
+        self.etag = None
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            self.etag = '"{0:x}-{1:x}"'.format(stat.st_mtime_ns, stat.st_size)
+            if self.headers.get("If-None-Match") == self.etag:
+                self.send_response(304)
+                self.end_headers()
+                return None
+        return super().send_head()
+
+    def end_headers(self):
+        if self.etag:
+            self.send_header("ETag", self.etag)
+        super().end_headers()
+
+
+class Registry:
+    """
+    stand-in of the package registry that serves files in a directory,
+    metadata of packages are at packages/<name> and tarballs are at
+    tarballs/<name>-<version>.tgz
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.server = None
+        self.thread = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{0}".format(self.server.server_address[1])
+
+    @property
+    def requests(self):
+        return self.server.requests
+
+    @property
+    def statuses(self):
+        return self.server.statuses
+
+    @property
+    def connections(self):
+        return self.server.connections
+
+    def start(self):
+        handler = partial(RequestHandler, directory=self.directory)
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.server.requests = []
+        self.server.statuses = []
+        self.server.connections = 0
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def add_package(self, name, version, files=None, manifest=None):
+        """
+        add name@version that has package.json and files, the version
+        becomes the latest release
+        """
+        manifest = dict(manifest or {}, name=name, version=version)
+        files = dict(files or {}, **{"package.json": json.dumps(manifest)})
+        tarball = "{0}-{1}.tgz".format(name, version)
+        metadata_path = os.path.join(self.directory, "packages", name)
+
+        os.makedirs(os.path.join(self.directory, "tarballs"), exist_ok=True)
+        os.makedirs(os.path.dirname(metadata_path), exist_ok=True)
+        with tarfile.open(
+            os.path.join(self.directory, "tarballs", tarball), "w:gz"
+        ) as archive:
+            for path, content in files.items():
+                data = content.encode("utf-8")
+                info = tarfile.TarInfo("package/" + path)
+                info.size = len(data)
+                archive.addfile(info, io.BytesIO(data))
+
+        try:
+            with open(metadata_path) as f:
+                metadata = json.load(f)
+        except OSError:
+            metadata = {"name": name, "versions": {}}
+
+        metadata["releases"] = {"latest": version}
+        metadata["versions"][version] = dict(
+            manifest, dist={"tarball": "../tarballs/" + tarball}
+        )
+        with open(metadata_path, "w") as f:
+            json.dump(metadata, f)
@@ -76,7 +76,7 @@ class TestAtomeRole(unittest.TestCase):
         process = subprocess.run(command, stdout=PIPE, stderr=PIPE)
         print_stdout(process)
         actual = get_playbook_results(process)
-        expected = {"ok": "1", "changed": "1", "unreachable": "0", "failed": "0"}
+        expected = {"ok": "2", "changed": "1", "unreachable": "0", "failed": "0"}
         self.assertEqual(0, process.returncode)
         self.assertDictEqual(expected, actual)
 
@@ -93,7 +93,7 @@ class TestAtomeRole(unittest.TestCase):
         process = subprocess.run(command, stdout=PIPE, stderr=PIPE)
         print_stdout(process)
         actual = get_playbook_results(process)
-        expected = {"ok": "1", "changed": "0", "unreachable": "0", "failed": "0"}
+        expected = {"ok": "2", "changed": "0", "unreachable": "0", "failed": "0"}
         self.assertEqual(0, process.returncode)
         self.assertDictEqual(expected, actual)
 
@@ -110,7 +110,7 @@ class TestAtomeRole(unittest.TestCase):
         process = subprocess.run(command, stdout=PIPE, stderr=PIPE)
         print_stdout(process)
         actual = get_playbook_results(process)
-        expected = {"ok": "1", "changed": "1", "unreachable": "0", "failed": "0"}
+        expected = {"ok": "2", "changed": "1", "unreachable": "0", "failed": "0"}
         self.assertEqual(0, process.returncode)
         self.assertDictEqual(expected, actual)
 
@@ -127,7 +127,7 @@ class TestAtomeRole(unittest.TestCase):
         process = subprocess.run(command, stdout=PIPE, stderr=PIPE)
         print_stdout(process)
         actual = get_playbook_results(process)
-        expected = {"ok": "1", "changed": "0", "unreachable": "0", "failed": "0"}
+        expected = {"ok": "2", "changed": "0", "unreachable": "0", "failed": "0"}
         self.assertEqual(0, process.returncode)
         self.assertDictEqual(expected, actual)
 